@@ -2,6 +2,8 @@
 
 # Requires img2pdf package! pip3 install img2pdf
 # As well as ImageMagick! (provides `magick`)
+# Optionally uses pyvips or Pillow (with pillow-avif-plugin and pillow-jxl-plugin) to convert pages without magick
+# Optionally uses pikepdf to share repeated pages and write compact PDFs
 
 # TODO better exception handling when pngs contain alpha
 
@@ -11,9 +13,47 @@ import sys
 import re
 import subprocess
 import tempfile
+import json
+import hashlib
+import multiprocessing
+import threading
+import time
+import importlib
+import io
+import shutil
+import zipfile
+import contextlib
+import collections
+import platform
 import img2pdf
 from concurrent import futures
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+# Optional in-process image backends
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+else:
+    for plugin in ("pillow_avif", "pillow_jxl"):
+        try:
+            importlib.import_module(plugin)
+        except ImportError:
+            pass
+
 # Functions for natural sorting
 _regex_seps = re.compile(r"[-_:,'\u02bc\u02b9\u02bd\u02be\u02bf\|\[\]\(\)#]")
 _regex_volume = re.compile(r"^\s*volume|vol\.?")
@@ -49,13 +89,224 @@ def natural_keys(text):
 
     return [ atoi(c) for c in _regex_split.split(text) ]
 
-tempdir_filecounter = 0
-def tempdir_filename() -> bytes:
-    global tempdir_filecounter
-    tempdir_filecounter += 1
-    return os.fsencode(os.path.join(tempdir, 'tmp%s.jpg'%str(tempdir_filecounter)))
+def volume_and_chapter(text):
+    '''
+    Returns the (volume, chapter) numbers that natural_keys detected in text.
+    Either one is None if text has no such marker.
+    '''
+    volume = None
+    chapter = None
+    keys = natural_keys(text)
+    # natural_keys turns markers into "V" and "VC" which are followed by their number
+    for marker, value in zip(keys, keys[1:]):
+        if isinstance(marker, str) and isinstance(value, float):
+            if marker.startswith('VC'):
+                chapter = value
+            elif marker.startswith('V'):
+                volume = value
+    return volume, chapter
+
+def format_number(value, width=2) -> str:
+    if value == int(value):
+        return str(int(value)).zfill(width)
+    return str(value).zfill(width + 2)
+
+# Functions for reading image dimensions from file headers
+_png_signature = b'\x89PNG\r\n\x1a\n'
+def read_exif_orientation(exif: bytes) -> int:
+    '''
+    Reads the orientation tag from the first image file directory of an Exif block.
+    @returns orientation from 1 to 8 or None if exif holds none
+    '''
+    if not exif.startswith(b'Exif\x00\x00'):
+        return None
+    tiff = exif[6:]
+    byteorder = { b'II': 'little', b'MM': 'big' }.get(tiff[:2])
+    if byteorder is None or len(tiff) < 8:
+        return None
+    ifd = int.from_bytes(tiff[4:8], byteorder)
+    count = int.from_bytes(tiff[ifd:ifd + 2], byteorder)
+    for entry in range(ifd + 2, min(ifd + 2 + count * 12, len(tiff) - 11), 12):
+        if int.from_bytes(tiff[entry:entry + 2], byteorder) == 0x0112:
+            return int.from_bytes(tiff[entry + 8:entry + 10], byteorder)
+    return None
+
+def read_jpeg_size(fhandle):
+    # walk the JPEG markers up to the first start of frame
+    if fhandle.read(2) != b'\xff\xd8':
+        return None
+    orientation = None
+    while True:
+        byte = fhandle.read(1)
+        while byte and byte != b'\xff':
+            byte = fhandle.read(1)
+        while byte == b'\xff':
+            byte = fhandle.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+            # markers without payload
+            continue
+        length = int.from_bytes(fhandle.read(2), 'big')
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            frame = fhandle.read(5)
+            if len(frame) < 5:
+                return None
+            width, height = int.from_bytes(frame[3:5], 'big'), int.from_bytes(frame[1:3], 'big')
+            # every backend turns pages along their Exif orientation before fitting them
+            if orientation in (5, 6, 7, 8):
+                return height, width
+            return width, height
+        if marker == 0xe1 and orientation is None:
+            orientation = read_exif_orientation(fhandle.read(length - 2))
+            continue
+        fhandle.seek(length - 2, os.SEEK_CUR)
+
+def read_png_info(fhandle):
+    '''
+    Reads the PNG chunks in front of the image data.
+    @returns (width, height, has_alpha) or None if this is no valid PNG
+    '''
+    if fhandle.read(8) != _png_signature:
+        return None
+    size = None
+    has_alpha = False
+    while True:
+        chunk_header = fhandle.read(8)
+        if len(chunk_header) < 8:
+            return None
+        length = int.from_bytes(chunk_header[:4], 'big')
+        chunk_type = chunk_header[4:]
+        if chunk_type == b'IHDR':
+            ihdr = fhandle.read(13)
+            if len(ihdr) < 13:
+                return None
+            size = int.from_bytes(ihdr[0:4], 'big'), int.from_bytes(ihdr[4:8], 'big')
+            # colour types 4 and 6 are grayscale and RGB with alpha channel
+            has_alpha = ihdr[9] in (4, 6)
+            fhandle.seek(length - 13 + 4, os.SEEK_CUR)
+        elif chunk_type == b'tRNS':
+            # transparency of palette entries or of a single colour
+            has_alpha = True
+            fhandle.seek(length + 4, os.SEEK_CUR)
+        elif chunk_type in (b'IDAT', b'IEND') or size is None:
+            # tRNS has to come before the image data
+            return size and (size[0], size[1], has_alpha)
+        else:
+            fhandle.seek(length + 4, os.SEEK_CUR)
+
+def read_webp_size(fhandle):
+    # the first chunk holds the dimensions in a layout that depends on the kind of WebP
+    head = fhandle.read(30)
+    if len(head) < 30 or head[:4] != b'RIFF' or head[8:12] != b'WEBP':
+        return None
+    if head[12:16] == b'VP8X':
+        return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+    elif head[12:16] == b'VP8 ':
+        return int.from_bytes(head[26:28], 'little') & 0x3fff, int.from_bytes(head[28:30], 'little') & 0x3fff
+    elif head[12:16] == b'VP8L':
+        bits = int.from_bytes(head[21:25], 'little')
+        return (bits & 0x3fff) + 1, (bits >> 14 & 0x3fff) + 1
+    return None
+
+def png_has_alpha(in_file) -> bool:
+    try:
+        with open_page(in_file) as fhandle:
+            png_info = read_png_info(fhandle)
+    except (OSError, zipfile.BadZipFile):
+        png_info = None
+    # let magick deal with anything unreadable
+    return png_info is None or png_info[2]
+
+def read_image_size(in_file):
+    '''
+    Reads width and height of JPEG, PNG and WebP files without decoding them.
+    @returns (width, height) or None if unknown
+    '''
+    name = page_name(in_file).lower()
+    try:
+        with open_page(in_file) as fhandle:
+            if name.endswith((b'.jpg', b'.jpeg')):
+                return read_jpeg_size(fhandle)
+            elif name.endswith(b'.png'):
+                png_info = read_png_info(fhandle)
+                return png_info and png_info[:2]
+            elif name.endswith(b'.webp'):
+                return read_webp_size(fhandle)
+    except (OSError, zipfile.BadZipFile):
+        pass
+    return None
 
-def exec_cmd(cmd, output=None):
+# Functions for reading pages from CBZ and ZIP archives without extracting them
+# Pages are either paths or members of an archive, which may be nested in other archives
+ArchiveMember = collections.namedtuple('ArchiveMember', ['archive', 'members', 'file_size', 'crc'])
+_image_endings = (b'.jpg', b'.jpeg', b'.png', b'.webp', b'.avif', b'.jxl')
+_archive_endings = (b'.cbz', b'.zip')
+
+def member_keys(member_name: str):
+    # sort members directory by directory like os.walk does
+    return [ natural_keys(part) for part in member_name.split('/') ]
+
+def list_archive(zfile: zipfile.ZipFile, archive: bytes, members=()) -> list:
+    '''
+    @returns sorted list of ArchiveMember pages in zfile and the archives nested in it
+    '''
+    pages = []
+    infos = [ info for info in zfile.infolist() if not info.is_dir() ]
+    for info in sorted(infos, key=lambda info: member_keys(info.filename)):
+        name = os.fsencode(info.filename.lower())
+        if name.endswith(_image_endings):
+            pages.append(ArchiveMember(archive, members + (info.filename,), info.file_size, info.CRC))
+        elif name.endswith(_archive_endings):
+            nested_members = members + (info.filename,)
+            pages.extend(list_archive(open_archive(archive, nested_members), archive, nested_members))
+    return pages
+
+_archive_handles = {}
+_archive_lock = threading.RLock()
+
+def open_archive(archive: bytes, members=()) -> zipfile.ZipFile:
+    '''
+    Opens an archive, or the archive nested in it along members, once per run.
+    Nested archives are inflated into a temporary file on first use, so that their pages can be seeked to.
+    '''
+    with _archive_lock:
+        zfile = _archive_handles.get((archive, members))
+        if zfile is None:
+            if members:
+                spill_fhandle = tempfile.TemporaryFile()
+                with open_archive(archive, members[:-1]).open(members[-1]) as nested_fhandle:
+                    shutil.copyfileobj(nested_fhandle, spill_fhandle)
+                zfile = zipfile.ZipFile(spill_fhandle)
+            else:
+                zfile = zipfile.ZipFile(os.fsdecode(archive))
+            _archive_handles[(archive, members)] = zfile
+        return zfile
+
+@contextlib.contextmanager
+def open_page(page):
+    '''
+    Opens a page for reading, no matter whether it is a file or an archive member.
+    '''
+    if not isinstance(page, ArchiveMember):
+        with open(page, 'rb') as fhandle:
+            yield fhandle
+        return
+    # ZipFile hands out members to several threads at once
+    with open_archive(page.archive, page.members[:-1]).open(page.members[-1]) as fhandle:
+        yield fhandle
+
+def read_page(page) -> bytes:
+    with open_page(page) as fhandle:
+        return fhandle.read()
+
+def page_name(page) -> bytes:
+    if isinstance(page, ArchiveMember):
+        return os.fsencode(page.members[-1].rsplit('/', 1)[-1])
+    return os.path.basename(page)
+
+def exec_cmd(cmd, output=None, page_data=None):
     if isinstance(cmd, str):
         cmd = cmd.split(' ')
 
@@ -65,39 +316,82 @@ def exec_cmd(cmd, output=None):
         si.dwFlags = subprocess.BELOW_NORMAL_PRIORITY_CLASS
         if args.v:
             print("  Executing command: {}".format(cmd))
-        return subprocess.run(cmd, shell=False, stdout=output, stderr=subprocess.STDOUT, startupinfo=si)
+        return subprocess.run(cmd, shell=False, input=page_data, stdout=output, stderr=subprocess.STDOUT, startupinfo=si)
     elif sys.platform == 'linux' or sys.platform == 'darwin':
         cmd.insert(0, "nice")
         cmd.insert(1, "-n19")
         if args.v:
             print("  Executing command: {}".format(cmd))
-        return subprocess.run(cmd, shell=False, stdout=output, stderr=subprocess.STDOUT)
+        return subprocess.run(cmd, shell=False, input=page_data, stdout=output, stderr=subprocess.STDOUT)
     else:
         if args.v:
             print("  Executing command: {}".format(cmd))
-        return subprocess.run(cmd, shell=False, stdout=output, stderr=subprocess.STDOUT)
+        return subprocess.run(cmd, shell=False, input=page_data, stdout=output, stderr=subprocess.STDOUT)
 
-# Check for runtime dependencies
-try:
-    subprocess.call(["magick", "-version"], stdout=subprocess.PIPE, shell=False)
+# Screen resolution (portrait), grayscale and bit depth of common reading devices
+device_profiles = {
+    "kindle-paperwhite": (1072, 1448, True, 8),
+    "kindle-paperwhite-5": (1236, 1648, True, 8),
+    "kindle-oasis": (1264, 1680, True, 8),
+    "kindle-scribe": (1860, 2480, True, 8),
+    "kobo-clara": (1072, 1448, True, 8),
+    "kobo-clara-colour": (1072, 1448, False, 8),
+    "kobo-libra": (1264, 1680, True, 8),
+    "kobo-sage": (1440, 1920, True, 8),
+    "remarkable-2": (1404, 1872, True, 8),
+    "tablet": (1600, 2560, False, 8),
+}
 
-except (subprocess.SubprocessError, FileNotFoundError) as e:
-    print(e)
-    print("This uses the `magick` command from ImageMagick. You need to make sure that ImageMagick is installed.")
-    exit(-1)
+# Argument custom validators
+def argcheck_resolution(string) -> tuple:
+    try:
+        width, height = [ int(el) for el in string.strip().lower().split('x') ]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected a resolution like: 1072x1448')
+    return min(width, height), max(width, height)
+
+def argcheck_size(string) -> int:
+    units = {"b": 1,
+             "kb": 1000, "k": 1000, "kib": 1024,
+             "mb": 1000**2, "m": 1000**2, "mib": 1024**2,
+             "gb": 1000**3, "g": 1000**3, "gib": 1024**3,
+             "tb": 1000**4, "t": 1000**4, "tib": 1024**4}
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([a-z]*)", string.strip().lower())
+    if not match or match.group(2) not in units and match.group(2) != "":
+        raise argparse.ArgumentTypeError('Expected a size like: 500MiB or 2GiB')
+    return max(0, int(float(match.group(1)) * units.get(match.group(2), 1)))
+
+default_cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "pymediascripts", "imagesToPdf")
+calibration_file = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "pymediascripts", "calibration", "imagesToPdf.json")
 
 # Argument handling
 try:
     parser = argparse.ArgumentParser()
-    parser.add_argument("in_folder_name", help="path to input folder with subdirs of pngs and jpgs")
+    parser.add_argument("in_folder_name", help="path to input folder with subdirs of pngs and jpgs. CBZ and ZIP archives in it, or a single archive, are read without extracting them.")
     parser.add_argument("out_pdf_name", help="filename of output pdf")
     parser.add_argument("--b5pagesize", help="Set page size to B5 which is the standard for printed manga. This ensures that page size is not image resolution dependent and consistent.", action="store_true")
     parser.add_argument("--no_png_alpha_removal", help="Remove alpha channel of all PNGs by converting them before adding to the PDF.", action="store_true")
     parser.add_argument("--no_webp_to_jpg", help="Unless set, all WebP images are converted to JPG for higher compatibility with older Ereaders and software", action="store_true")
     parser.add_argument("--no_avif_to_jpg", help="Unless set, all AVIF images are converted to JPG for higher compatibility with older Ereaders and software", action="store_true")
     parser.add_argument("--no_jxl_to_jpg", help="Unless set, all JXL images are converted to JPG for higher compatibility with older Ereaders and software", action="store_true")
+    parser.add_argument("--device", choices=sorted(device_profiles), help="Downscale pages to the screen of this reading device and convert them to grayscale if it has an e-ink screen. Pages that already fit are added as is.")
+    parser.add_argument("--target_resolution", type=argcheck_resolution, help="Downscale pages that do not fit into this resolution, e.g. 1072x1448. Overrides the resolution of --device.")
+    parser.add_argument("--grayscale", help="Convert pages to grayscale whenever they are converted anyway.", action="store_true")
+    parser.add_argument("--bit_depth", type=int, choices=[1, 2, 4, 8], help="Reduce the bit depth of converted pages. Values below 8 only pay off for PNGs.")
+    parser.add_argument("--cache_dir", default=default_cache_dir, help="Directory in which converted pages are kept across runs. Pages are reused as long as their content and the conversion options are unchanged.")
+    parser.add_argument("--cache_size", default="2GiB", type=argcheck_size, help="Maximum size of the page cache. The least recently used pages are removed first.")
+    parser.add_argument("--no_cache", help="Do not keep converted pages after this run.", action="store_true")
+    parser.add_argument("--backend", default="auto", choices=["auto", "vips", "pillow", "magick"], help="Image library used for page conversion. auto prefers the in-process libraries pyvips and Pillow. Formats they cannot read are converted with magick.")
+    parser.add_argument("--benchmark", default=0, type=int, metavar="PAGES", help="Convert this many pages with every available backend, print pages per second and exit.")
+    parser.add_argument("--no_dedupe", help="Unless set, identical page images such as repeated credit, cover or blank pages are stored only once in the PDF. Requires pikepdf.", action="store_true")
+    parser.add_argument("--object_streams", help="Pack PDF objects into compressed object streams with a compressed cross-reference table. Requires pikepdf.", action="store_true")
+    parser.add_argument("--linearize", help="Linearize the PDF so that readers can show the first pages before loading the whole file. Requires pikepdf.", action="store_true")
+    parser.add_argument("--split", choices=["volume", "chapters"], help="Write one PDF per volume or per group of chapters instead of a single PDF. Files are named after out_pdf_name and listed in an index file next to them. Re-running only rebuilds PDFs whose pages changed.")
+    parser.add_argument("--chapters_per_pdf", default=10, type=int, help="Number of chapters per PDF when using --split chapters.")
+    parser.add_argument("--max_workers", default=os.cpu_count(), type=int, help="Set max parallel conversion and PDF assembly tasks. By default is your CPU thread count.")
     parser.add_argument("-v", help="Verbose mode", action="store_true")
     parser.add_argument("--dry", help="Dry run. Useful to check the chapter order.", action="store_true")
+    parser.add_argument("--plan", help="Do not convert anything. Count the pages and PDFs that would be built, read their pixel count and estimate run time and output size from earlier runs with the same options on this host.", action="store_true")
 
     args = parser.parse_args()
 
@@ -109,86 +403,766 @@ except:
 in_dir = os.fsencode(args.in_folder_name.strip())
 out_file = os.fsencode(args.out_pdf_name.strip())
 
+# Check for runtime dependencies
+try:
+    subprocess.call(["magick", "-version"], stdout=subprocess.PIPE, shell=False)
+    magick_available = True
+
+except (subprocess.SubprocessError, FileNotFoundError) as e:
+    magick_available = False
+    if (pyvips is None and Image is None) or args.backend == "magick":
+        print(e)
+        print("This uses the `magick` command from ImageMagick. You need to make sure that ImageMagick is installed.")
+        exit(-1)
+    print("The `magick` command from ImageMagick was not found. Pages in formats that {} cannot read are added as is.".format("pyvips" if pyvips else "Pillow"))
+
+if pikepdf is None and (args.object_streams or args.linearize):
+    print("--object_streams and --linearize require the pikepdf package. pip3 install pikepdf")
+    exit(-1)
+
+# apply device profile
+if args.device:
+    device_width, device_height, device_grayscale, device_depth = device_profiles[args.device]
+    if not args.target_resolution:
+        args.target_resolution = (device_width, device_height)
+    args.grayscale = args.grayscale or device_grayscale
+    if not args.bit_depth and device_depth < 8:
+        args.bit_depth = device_depth
+
+def page_relpath(page) -> str:
+    # archives appear as directories of the path
+    if isinstance(page, ArchiveMember):
+        parts = [ part for member in page.members for part in member.split('/') ]
+        return os.path.join(os.fsdecode(os.path.relpath(page.archive, in_dir)), *parts)
+    return os.fsdecode(os.path.relpath(page, in_dir))
+
+def split_into_groups(in_files: list) -> list:
+    '''
+    Splits the sorted input files into the PDFs that shall be created.
+    @returns list of (out_pdf_path, label, in_files)
+    '''
+    if not args.split:
+        return [ (out_file, None, in_files) ]
+
+    groups = []
+    if args.split == "volume":
+        for in_file in in_files:
+            # the innermost volume marker of the path wins
+            volume = None
+            for part in page_relpath(in_file).split(os.sep):
+                part_volume, part_chapter = volume_and_chapter(part)
+                if part_volume is not None:
+                    volume = part_volume
+            if not groups or groups[-1][0] != volume:
+                groups.append((volume, []))
+            groups[-1][1].append(in_file)
+
+        if all(volume is None for volume, pages in groups):
+            print("No volume markers found. Writing a single PDF instead.")
+            return [ (out_file, None, in_files) ]
+
+        labels = [ "Vol. " + format_number(volume) if volume is not None else "Specials"
+                   for volume, pages in groups ]
+    else:
+        # every directory holding pages is treated as one chapter
+        chapters = []
+        for in_file in in_files:
+            chapter_dir = os.path.dirname(page_relpath(in_file))
+            if not chapters or chapters[-1][0] != chapter_dir:
+                chapters.append((chapter_dir, []))
+            chapters[-1][1].append(in_file)
+
+        labels = []
+        chunk_size = max(1, args.chapters_per_pdf)
+        for index in range(0, len(chapters), chunk_size):
+            chunk = chapters[index:index + chunk_size]
+            first_chapter = volume_and_chapter(os.path.basename(chunk[0][0]))[1]
+            last_chapter = volume_and_chapter(os.path.basename(chunk[-1][0]))[1]
+            if first_chapter is not None and first_chapter == last_chapter:
+                labels.append("Ch. {}".format(format_number(first_chapter, 3)))
+            elif first_chapter is not None and last_chapter is not None:
+                labels.append("Ch. {}-{}".format(format_number(first_chapter, 3), format_number(last_chapter, 3)))
+            else:
+                labels.append("Part {}".format(format_number(index // chunk_size + 1)))
+            groups.append((None, [ page for chapter_dir, pages in chunk for page in pages ]))
+
+    # a label can only appear once, pages of repeated labels are merged
+    merged = {}
+    for label, (key, pages) in zip(labels, groups):
+        merged.setdefault(label, []).extend(pages)
+
+    out_stem, out_ext = os.path.splitext(out_file)
+    return [ (out_stem + b" - " + os.fsencode(label) + (out_ext or b".pdf"), label, pages)
+             for label, pages in merged.items() ]
+
+def page_signature(in_file) -> list:
+    if isinstance(in_file, ArchiveMember):
+        return [ page_relpath(in_file), in_file.file_size, in_file.crc ]
+    stat = os.stat(in_file)
+    return [ page_relpath(in_file), stat.st_size, stat.st_mtime_ns ]
+
+def build_options() -> dict:
+    # all options that change the contents of the resulting PDFs
+    return { "b5pagesize": args.b5pagesize,
+             "no_png_alpha_removal": args.no_png_alpha_removal,
+             "no_webp_to_jpg": args.no_webp_to_jpg,
+             "no_avif_to_jpg": args.no_avif_to_jpg,
+             "no_jxl_to_jpg": args.no_jxl_to_jpg,
+             # a list, as that is what the resolution becomes when the index is read back from JSON
+             "target_resolution": args.target_resolution and list(args.target_resolution),
+             "grayscale": args.grayscale,
+             "bit_depth": args.bit_depth,
+             "dedupe": not args.no_dedupe and pikepdf is not None,
+             "object_streams": args.object_streams,
+             "linearize": args.linearize }
+
+def pdf_object_key(obj) -> bytes:
+    # serialises obj including the contents of nested streams, but not where they are stored
+    if isinstance(obj, (pikepdf.Dictionary, pikepdf.Stream)):
+        key = b'<<' + b''.join(os.fsencode(name) + pdf_object_key(obj[name])
+                               for name in sorted(obj.keys()) if name != '/Length') + b'>>'
+        if isinstance(obj, pikepdf.Stream):
+            key += hashlib.sha256(obj.read_raw_bytes()).digest()
+        return key
+    if isinstance(obj, pikepdf.Array):
+        return b'[' + b' '.join(pdf_object_key(element) for element in obj) + b']'
+    if isinstance(obj, pikepdf.Object):
+        return obj.unparse()
+    return os.fsencode(repr(obj))
+
+def compact_pdf(pdf_path: bytes, dedupe: bool, object_streams: bool, linearize: bool) -> int:
+    '''
+    Lets all pages with identical images share a single image XObject and rewrites the PDF.
+    @returns number of images that were replaced by a shared one
+    '''
+    shared_count = 0
+    with pikepdf.open(os.fsdecode(pdf_path), allow_overwriting_input=True) as pdf:
+        if dedupe:
+            images = {}
+            for page in pdf.pages:
+                xobjects = page.obj.get('/Resources', {}).get('/XObject')
+                if xobjects is None:
+                    continue
+                for name in list(xobjects.keys()):
+                    xobject = xobjects[name]
+                    if xobject.get('/Subtype') != '/Image':
+                        continue
+                    shared_image = images.setdefault(pdf_object_key(xobject), xobject)
+                    if shared_image.objgen != xobject.objgen:
+                        # the duplicate is dropped as nothing refers to it anymore
+                        xobjects[name] = shared_image
+                        shared_count += 1
+        if object_streams:
+            object_stream_mode = pikepdf.ObjectStreamMode.generate
+        else:
+            object_stream_mode = pikepdf.ObjectStreamMode.preserve
+        pdf.save(os.fsdecode(pdf_path), object_stream_mode=object_stream_mode, linearize=linearize)
+    return shared_count
+
+def create_pdf(page_files: list, pdf_path: bytes, b5pagesize: bool, dedupe: bool, object_streams: bool, linearize: bool):
+    # archive members are passed to img2pdf as they are, without temporary files
+    page_files = [ read_page(page) if isinstance(page, ArchiveMember) else page for page in page_files ]
+    with open(pdf_path, "wb") as outfhandle:
+        if b5pagesize:
+            b5inpt = (img2pdf.mm_to_pt(176), img2pdf.mm_to_pt(250))
+        else:
+            b5inpt = (img2pdf.mm_to_pt(176), None)
+        layout_fun = img2pdf.get_layout_fun(pagesize=b5inpt, auto_orient=True)
+        outfhandle.write(img2pdf.convert(page_files, with_pdfrw=False, rotation=img2pdf.Rotation.ifvalid, layout_fun=layout_fun))
+
+    if pikepdf is not None and (dedupe or object_streams or linearize):
+        shared_count = compact_pdf(pdf_path, dedupe, object_streams, linearize)
+        if args.v and shared_count:
+            print("  {} repeated page images are shared in {}".format(shared_count, os.fsdecode(os.path.basename(pdf_path))))
+
+def pdf_executor(max_workers: int) -> futures.Executor:
+    # Forking is required as spawned workers would run this whole script again
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+    return futures.ThreadPoolExecutor(max_workers=max_workers)
+
+def fit_box(size) -> tuple:
+    '''
+    @returns (width, height) that a page of the given size has to fit into
+    '''
+    # landscape pages such as double page spreads are fitted into the rotated screen
+    target_width, target_height = args.target_resolution
+    if size is not None and size[0] > size[1]:
+        target_width, target_height = target_height, target_width
+    return target_width, target_height
+
+def exceeds_target(size) -> bool:
+    if not args.target_resolution or size is None:
+        return False
+    target_width, target_height = fit_box(size)
+    return size[0] > target_width or size[1] > target_height
 
+# Conversion backends
+# Each one converts in_file to the format of out_file's suffix, fitted to the target device.
+def convert_magick(in_file, out_file: bytes, size) -> bool:
+    page_data = None
+    if isinstance(in_file, ArchiveMember):
+        # pipe archive members into magick
+        page_data = read_page(in_file)
+        cmd = [ 'magick', os.path.splitext(page_name(in_file))[1][1:].lower() + b':-', '-auto-orient' ]
+    else:
+        cmd = [ 'magick', in_file, '-auto-orient' ]
+    if args.target_resolution and size is None:
+        # the dimensions of AVIF and JXL pages are unknown, so magick picks the box matching their orientation
+        target_width, target_height = args.target_resolution
+        cmd.extend([ '-resize', '%[fx:w>h?{1}:{0}]x%[fx:w>h?{0}:{1}]>'.format(target_width, target_height) ])
+    elif exceeds_target(size):
+        # only ever shrink pages
+        cmd.extend([ '-resize', '{}x{}>'.format(*fit_box(size)) ])
+    if args.grayscale:
+        cmd.extend([ '-colorspace', 'Gray' ])
+    if args.bit_depth:
+        cmd.extend([ '-depth', str(args.bit_depth) ])
+    cmd.extend([ '-background', 'white', '-alpha', 'remove' ])
+    if out_file.endswith(b'.png'):
+        cmd.extend([ '-define', 'png:compression-level=9',
+                     '-define', 'png:compression-filter=6' ])
+    else:
+        cmd.extend([ '-quality', '90' ])
+        if not args.grayscale:
+            cmd.extend([ '-colorspace', 'YUV' ])
+        cmd.extend([ '-define', 'jpeg:dct-method=float',
+                     '-define', 'jpeg:optimize-coding=on' ])
+    cmd.extend([ '-strip', out_file ])
+    return exec_cmd(cmd, page_data=page_data).returncode == 0
+
+def convert_pillow(in_file, out_file: bytes, size) -> bool:
+    if isinstance(in_file, ArchiveMember):
+        image_source = io.BytesIO(read_page(in_file))
+    else:
+        image_source = os.fsdecode(in_file)
+    with Image.open(image_source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('I', 'I;16', 'I;16B', 'I;16L'):
+            # convert('L') clips 16 bit grayscale scans instead of scaling them down to 8 bit
+            image = image.convert('I').point(lambda value: value / 256).convert('L')
+        if args.target_resolution:
+            # thumbnail only ever shrinks pages
+            image.thumbnail(fit_box(image.size), Image.Resampling.LANCZOS)
+        if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+            image = image.convert('RGBA')
+            image = Image.alpha_composite(Image.new('RGBA', image.size, 'white'), image)
+        if args.grayscale or image.mode in ('1', 'L', 'LA'):
+            image = image.convert('L')
+        else:
+            image = image.convert('RGB')
+        if args.bit_depth and args.bit_depth < 8:
+            image = ImageOps.posterize(image, args.bit_depth)
+        if out_file.endswith(b'.png'):
+            image.save(os.fsdecode(out_file), 'PNG', compress_level=9)
+        else:
+            image.save(os.fsdecode(out_file), 'JPEG', quality=90, optimize=True)
+    return True
+
+def convert_vips(in_file, out_file: bytes, size) -> bool:
+    if isinstance(in_file, ArchiveMember):
+        image = pyvips.Image.new_from_buffer(read_page(in_file), "").autorot()
+    else:
+        image = pyvips.Image.new_from_file(os.fsdecode(in_file)).autorot()
+    if args.target_resolution:
+        target_width, target_height = fit_box((image.width, image.height))
+        image = image.thumbnail_image(target_width, height=target_height, size='down')
+    if image.hasalpha():
+        image = image.flatten(background=[255] * (image.bands - 1))
+    if args.grayscale:
+        image = image.colourspace('b-w')
+    if out_file.endswith(b'.png'):
+        if args.bit_depth and args.bit_depth < 8 and image.bands == 1:
+            image.pngsave(os.fsdecode(out_file), compression=9, bitdepth=args.bit_depth, strip=True)
+        else:
+            image.pngsave(os.fsdecode(out_file), compression=9, strip=True)
+    else:
+        if args.bit_depth and args.bit_depth < 8:
+            image = image.cast('uchar') & (0xff << (8 - args.bit_depth) & 0xff)
+        image.jpegsave(os.fsdecode(out_file), Q=90, optimize_coding=True, strip=True)
+    return True
+
+backends = { "magick": convert_magick, "pillow": convert_pillow, "vips": convert_vips }
+
+def detect_backend_formats() -> dict:
+    '''
+    @returns dict of available backends and the file endings they can read, None meaning all
+    '''
+    backend_formats = {}
+    if pyvips is not None:
+        formats = { b'.jpg', b'.jpeg', b'.png', b'.webp' }
+        if pyvips.type_find("VipsOperation", "heifload") != 0:
+            formats.add(b'.avif')
+        if pyvips.type_find("VipsOperation", "jxlload") != 0:
+            formats.add(b'.jxl')
+        backend_formats["vips"] = formats
+    if Image is not None:
+        backend_formats["pillow"] = { os.fsencode(ext) for ext, fmt in Image.registered_extensions().items()
+                                      if fmt in Image.OPEN }
+    if magick_available:
+        backend_formats["magick"] = None
+    return backend_formats
+
+def page_backend(in_file) -> str:
+    # fall back to magick for formats the in-process backend cannot read
+    formats = backend_formats.get(args.backend)
+    if formats is None or os.path.splitext(page_name(in_file))[1].lower() in formats:
+        return args.backend
+    return "magick"
+
+def convert_with_backend(backend: str, in_file, out_file: bytes, size) -> bool:
+    try:
+        return backends[backend](in_file, out_file, size)
+    except Exception as e:
+        if args.v:
+            print("  {} failed to convert {}: {}".format(backend, page_relpath(in_file), e))
+        if backend != "magick" and magick_available:
+            return convert_magick(in_file, out_file, size)
+        return False
+
+def run_benchmark(in_files: list, page_count: int):
+    '''
+    Converts the first pages that need conversion with every available backend and prints pages/sec.
+    '''
+    sample = []
+    for in_file in in_files:
+        conversion = page_conversion(in_file)
+        if conversion is not None:
+            sample.append((in_file, conversion))
+        if len(sample) == page_count:
+            break
+    if not sample:
+        # nothing needs to be converted, so compare plain JPG re-encoding
+        sample = [ (in_file, (b'.jpg', None)) for in_file in in_files[:page_count] ]
+    print("Benchmarking {} pages with {} workers".format(len(sample), args.max_workers))
+
+    for backend, formats in backend_formats.items():
+        pages = [ (in_file, suffix, size) for in_file, (suffix, size) in sample
+                  if formats is None or os.path.splitext(page_name(in_file))[1].lower() in formats ]
+        if not pages:
+            print("  {}: cannot read any of the sample pages".format(backend))
+            continue
+        with tempfile.TemporaryDirectory() as benchdir:
+            start_time = time.monotonic()
+            with futures.ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+                tasks = [ executor.submit(convert_with_backend, backend, in_file,
+                                          os.path.join(os.fsencode(benchdir), b'%d' % index + suffix), size)
+                          for index, (in_file, suffix, size) in enumerate(pages) ]
+                converted = sum(1 for task in tasks if task.result())
+            elapsed = time.monotonic() - start_time
+        print("  {}: {} of {} pages in {:.2f}s, {:.1f} pages/sec".format(backend, converted, len(pages), elapsed, len(pages) / elapsed))
+
+def file_hash(in_file) -> str:
+    digest = hashlib.sha256()
+    with open_page(in_file) as fhandle:
+        for chunk in iter(lambda: fhandle.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def convert_cached(cache_root: bytes, in_file, suffix: bytes, size):
+    '''
+    Converts in_file unless the cache already holds a conversion of the same content with the same options.
+    @returns path to the converted page
+    '''
+    backend = page_backend(in_file)
+    # backends differ slightly in their output, so they are part of the conversion parameters
+    params = (backend, suffix, args.target_resolution and fit_box(size), args.grayscale, args.bit_depth)
+    key = hashlib.sha256((file_hash(in_file) + repr(params)).encode()).hexdigest()
+    cached_file = os.path.join(cache_root, os.fsencode(key[:2]), os.fsencode(key) + suffix)
+    if os.path.exists(cached_file):
+        if os.path.getmtime(cached_file) < run_started_at:
+            cached_pages.append(in_file)
+        # refresh the entry for the LRU eviction
+        os.utime(cached_file)
+        if args.v:
+            print("  Using cached conversion of " + page_relpath(in_file))
+        return cached_file
+
+    os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+    # write to a name unique to this thread first so that no one ever sees a partial file
+    partial_file = cached_file[:-len(suffix)] + b'.%d-%d' % (os.getpid(), threading.get_ident()) + suffix
+    if not convert_with_backend(backend, in_file, partial_file, size) or not os.path.exists(partial_file):
+        print("  Conversion of {} failed. Adding it as is.".format(page_relpath(in_file)))
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        return in_file
+    os.replace(partial_file, cached_file)
+    return cached_file
+
+_cache_entry = re.compile(rb"([0-9a-f]{2})[0-9a-f]{62}(\.\d+-\d+)?\.\w+")
+def evict_cache(cache_root: bytes, max_size: int):
+    '''
+    Removes least recently used pages until the cache fits into max_size.
+    Only files laid out like cache entries are touched, so other files in cache_root are left alone.
+    '''
+    if not os.path.isdir(cache_root):
+        return
+    entries = []
+    for subdir in os.listdir(cache_root):
+        subdir_path = os.path.join(cache_root, subdir)
+        if not re.fullmatch(rb"[0-9a-f]{2}", subdir) or not os.path.isdir(subdir_path):
+            continue
+        for name in os.listdir(subdir_path):
+            match = _cache_entry.fullmatch(name)
+            if not match or match.group(1) != subdir:
+                continue
+            path = os.path.join(subdir_path, name)
+            try:
+                stat = os.stat(path)
+                if match.group(2):
+                    # partial files of crashed runs, running ones are younger than an hour
+                    if time.time() - stat.st_mtime > 3600:
+                        os.remove(path)
+                    continue
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total_size = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError:
+            pass
+
+    for subdir in os.listdir(cache_root):
+        if re.fullmatch(rb"[0-9a-f]{2}", subdir):
+            try:
+                os.rmdir(os.path.join(cache_root, subdir))
+            except OSError:
+                # still holds pages
+                pass
+
+def page_conversion(in_file):
+    '''
+    Decides whether in_file has to be converted before it can be added to the PDF.
+    Pages are downscaled and converted to grayscale for the target device in the same pass.
+    @returns (suffix, size) of the conversion or None if the page is added as is
+    '''
+    name = page_name(in_file)
+    if name.lower().endswith((b'.jpg', b'.jpeg')):
+        size = read_image_size(in_file)
+        if not exceeds_target(size):
+            return None
+        # downscale the JPG
+        return b'.jpg', size
+
+    if name.lower().endswith((b'.png')):
+        size = read_image_size(in_file)
+        # We cannot have an alpha channel in PNGs, most of them have none to begin with
+        if (args.no_png_alpha_removal or not png_has_alpha(in_file)) and not exceeds_target(size):
+            return None
+        # remove the transparancy from the PNG and downscale it
+        return b'.png', size
+
+    convert_the_image = False
+    if name.lower().endswith((b'.webp')):
+        convert_the_image = not args.no_webp_to_jpg
+    elif name.lower().endswith((b'.avif')):
+        convert_the_image = not args.no_avif_to_jpg
+    elif name.lower().endswith((b'.jxl')):
+        convert_the_image = not args.no_jxl_to_jpg
+    if not convert_the_image:
+        return None
+
+    # convert the file to JPG
+    return b'.jpg', read_image_size(in_file)
+
+def convert_page(executor: futures.Executor, cache_root: bytes, in_file):
+    '''
+    Submits the conversion of in_file if it is needed for the PDF.
+    @returns path of the file that is to be added to the PDF or a future of it
+    '''
+    conversion = page_conversion(in_file)
+    if conversion is None:
+        return in_file
+    suffix, size = conversion
+    return executor.submit(convert_cached, cache_root, in_file, suffix, size)
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} TiB".format(size)
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}h {:02d}m {:02d}s".format(hours, minutes, seconds)
+
+def cpu_time() -> float:
+    # CPU time of this process and of all finished magick and PDF assembly processes
+    if resource is None:
+        return 0.0
+    return sum(usage.ru_utime + usage.ru_stime for usage in (resource.getrusage(resource.RUSAGE_SELF),
+                                                             resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+def calibration_host() -> str:
+    '''
+    Names the hardware that estimates are measured on. Containers get a new hostname on every run,
+    so the CPU model and the number of cores are used unless PYMEDIASCRIPTS_CALIBRATION_HOST is set.
+    '''
+    host = os.environ.get("PYMEDIASCRIPTS_CALIBRATION_HOST")
+    if host:
+        return host
+    cpu_model = platform.processor() or platform.machine()
+    try:
+        with open("/proc/cpuinfo", "r") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("model name"):
+                    cpu_model = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return "{} x{}".format(cpu_model, os.cpu_count())
+
+def calibration_key() -> str:
+    # estimates only carry over to runs on the same hardware with the same options
+    return "{} {} {}".format(calibration_host(), args.backend, json.dumps(build_options(), sort_keys=True))
+
+def load_calibration() -> dict:
+    try:
+        with open(calibration_file, "r") as calfhandle:
+            return json.load(calfhandle)
+    except (OSError, ValueError):
+        return {}
+
+def save_calibration(measured: dict):
+    calibration = load_calibration()
+    entry = calibration.setdefault(calibration_key(), {})
+    for field, value in measured.items():
+        # older runs fade out so that the estimates follow new hardware and library versions
+        entry[field] = entry.get(field, 0.0) * 0.75 + value
+    try:
+        os.makedirs(os.path.dirname(calibration_file), exist_ok=True)
+        partial_file = calibration_file + ".{}".format(os.getpid())
+        with open(partial_file, "w") as calfhandle:
+            json.dump(calibration, calfhandle, indent=1)
+        os.replace(partial_file, calibration_file)
+    except OSError as e:
+        print("Unable to store calibration data: {}".format(e))
+
+def plan_pages(pages: list, entry: dict) -> collections.Counter:
+    '''
+    Reads size and format of pages without converting them.
+    @returns page count, bytes and megapixels as well as the number of pages per format
+    '''
+    plan = collections.Counter()
+    formats = collections.Counter()
+    for page in pages:
+        size = page.file_size if isinstance(page, ArchiveMember) else os.path.getsize(page)
+        plan["pages"] += 1
+        plan["in_bytes"] += size
+        plan["convert" if page_conversion(page) is not None else "as_is"] += 1
+        formats[os.fsdecode(os.path.splitext(page_name(page))[1].lower().lstrip(b'.'))] += 1
+        dimensions = read_image_size(page)
+        if dimensions is None:
+            plan["unprobed_bytes"] += size
+        else:
+            plan["units"] += dimensions[0] * dimensions[1] / 1000000
+            plan["probed_bytes"] += size
+    # pages that could not be probed are assumed to be like the others of similar size
+    if plan["unprobed_bytes"] and plan["probed_bytes"]:
+        plan["units"] += plan["unprobed_bytes"] * plan["units"] / plan["probed_bytes"]
+    elif plan["unprobed_bytes"] and entry:
+        plan["units"] += plan["unprobed_bytes"] * entry["units"] / entry["in_bytes"]
+    return plan, formats
+
+def print_plan(pdf_groups: list, pending_groups: list):
+    entry = load_calibration().get(calibration_key())
+    plan, formats = plan_pages([ page for pdf_path, label, pages, signature in pending_groups for page in pages ], entry)
+    print("Plan for " + args.in_folder_name + " as " + args.out_pdf_name)
+    print("  {} of {} PDF files need to be built".format(len(pending_groups), len(pdf_groups)))
+    print("  {} pages ({}, {:.1f} megapixels): {} to convert, {} added as is".format(
+          plan["pages"], format_size(plan["in_bytes"]), plan["units"], plan["convert"], plan["as_is"]))
+    if formats:
+        print("  Formats: " + ", ".join("{} {}".format(ending, count) for ending, count in formats.most_common()))
+    if not entry:
+        print("  No calibration data for these options on {} yet. Convert once to calibrate the estimates.".format(calibration_host()))
+        return
+
+    print("  Estimated {} with {} workers, {} of CPU time, {} of output".format(
+          format_duration(plan["units"] * entry["slot_time"] / entry["units"] / min(args.max_workers, os.cpu_count())),
+          args.max_workers, format_duration(plan["units"] * entry["cpu_time"] / entry["units"]),
+          format_size(plan["in_bytes"] * entry["out_bytes"] / entry["in_bytes"])))
+
+backend_formats = detect_backend_formats()
+if args.backend == "auto":
+    args.backend = next(backend for backend in ("vips", "pillow", "magick") if backend in backend_formats)
+elif args.backend not in backend_formats:
+    print("The {} backend is not available. Make sure that it is installed.".format(args.backend))
+    exit(-1)
+
+if args.v:
+    print("Converting pages with " + args.backend)
 print("Working through directory " + args.in_folder_name + ". Output as " + args.out_pdf_name + ". This may take a while...")
 
 if args.dry:
     args.v = True
     print("This is dry mode. Only printing file order. No processing.")
 
+def collect_archive(archive: bytes) -> list:
+    try:
+        pages = list_archive(open_archive(archive), archive)
+    except (OSError, zipfile.BadZipFile) as e:
+        print("Unable to read archive {}: {}".format(str(archive), e))
+        return []
+    if args.v:
+        for page in pages:
+            print("  Archive member: " + page_relpath(page))
+    return pages
+
+def collect_dir(dirpath: bytes) -> list:
+    '''
+    @returns sorted list of the pages in dirpath and below it
+    '''
+    walked = next(os.walk(dirpath), None)
+    if walked is None:
+        return []
+    dirpath, dirnames, filenames = walked
+    if args.v:
+        print("Currently processing dir " + str(dirpath))
+    pages = []
+    # archives are read like directories, so they are sorted in between them
+    subtrees = [ (name, collect_dir) for name in dirnames if not os.path.islink(os.path.join(dirpath, name)) ]
+    for name in sorted(filenames, key=natural_keys):
+        if args.v:
+            print("  File: " + str(name))
+        # Evaluate file
+        if name.lower().endswith(_image_endings):
+            pages.append(os.path.join(dirpath, name))
+        elif name.lower().endswith(_archive_endings):
+            subtrees.append((name, collect_archive))
+    for name, collect in sorted(subtrees, key=lambda subtree: natural_keys(subtree[0])):
+        pages.extend(collect(os.path.join(dirpath, name)))
+    return pages
+
 # Collect input files sorted in list
 in_files_list = []
-alpha_files_list = []
+if os.path.isfile(in_dir) and in_dir.lower().endswith(_archive_endings):
+    in_archive = in_dir
+    in_dir = os.path.dirname(os.path.abspath(in_archive))
+    in_files_list.extend(collect_archive(in_archive))
+else:
+    in_files_list.extend(collect_dir(in_dir))
+
+if args.benchmark > 0:
+    run_benchmark(in_files_list, args.benchmark)
+    exit(0)
+
+pdf_groups = split_into_groups(in_files_list)
+if args.dry:
+    for pdf_path, label, pages in pdf_groups:
+        if label is not None:
+            print("{}: {} pages from {} to {}".format(os.fsdecode(pdf_path), len(pages), page_relpath(pages[0]), page_relpath(pages[-1])))
+    exit(0)
+
+# Compare with the index of the last run to skip PDFs whose pages did not change
+index_file = os.path.splitext(out_file)[0] + b".index.json"
+index = { "options": build_options(), "pdfs": {} }
+previous_pdfs = {}
+if args.split:
+    try:
+        with open(index_file, "r") as indexfhandle:
+            old_index = json.load(indexfhandle)
+        previous_pdfs = old_index.get("pdfs", {})
+        if old_index.get("options") == index["options"]:
+            index["pdfs"] = old_index.get("pdfs", {})
+    except (OSError, ValueError):
+        pass
+
+pending_groups = []
+for pdf_path, label, pages in pdf_groups:
+    pdf_name = os.fsdecode(os.path.basename(pdf_path))
+    signature = [ page_signature(page) for page in pages ]
+    index_entry = index["pdfs"].get(pdf_name)
+    if args.split and os.path.exists(pdf_path) and index_entry and index_entry["pages"] == signature:
+        if args.v:
+            print("Skipping unchanged " + pdf_name)
+        continue
+    index["pdfs"].pop(pdf_name, None)
+    pending_groups.append((pdf_path, label, pages, signature))
+
+if args.plan:
+    print_plan(pdf_groups, pending_groups)
+    exit(0)
 
-# use tempdir for image conversion
+# pages converted by an earlier run would make the calibration too optimistic
+cached_pages = []
+failed_pdfs = 0
+run_started_at = time.time()
+started_at = time.monotonic()
+started_cpu_time = cpu_time()
+
+# use tempdir for image conversion unless converted pages are cached
 with tempfile.TemporaryDirectory() as tempdir:
+    cache_root = os.fsencode(tempdir if args.no_cache else args.cache_dir)
 
     # use threadpool for image conversion
-    with futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        for dirpath, dirnames, filenames in os.walk(in_dir):
-            dirnames.sort(key=natural_keys)
-            if args.v:
-                print("Currently processing dir " + str(dirpath))
-            for name in sorted(filenames, key=natural_keys):
-                if args.v:
-                    print("  File: " + str(name))
-                # Evaluate file
-                if args.dry:
-                    continue
-                elif name.lower().endswith((b'.jpg', b'.jpeg')):
-                    in_files_list.append(os.path.join(dirpath, name))
-                elif name.lower().endswith((b'.png')):
-                    # We cannot have an alpha channel in PNGs
-                    if args.no_png_alpha_removal:
-                        in_files_list.append(os.path.join(dirpath, name))
-                    else:
-                        # Let ImageMagick remove the transparancy from the PNG
-                        no_alpha_filename = tempdir_filename()
-                        cmd = [ 'magick', os.path.join(dirpath, name),
-                               '-background', 'white', '-alpha', 'remove',
-                               '-define', 'png:compression-level=9',
-                               '-define', 'png:compression-filter=6',
-                               '-strip', '-auto-orient',
-                               no_alpha_filename ]
-                        executor.submit(exec_cmd, cmd)
-                        in_files_list.append(no_alpha_filename)
-                else:
-                    convert_the_image = False
-                    if name.lower().endswith((b'.webp')):
-                        if args.no_webp_to_jpg:
-                            in_files_list.append(os.path.join(dirpath, name))
-                        else:
-                            convert_the_image = True
-                    elif name.lower().endswith((b'.avif')):
-                        if args.no_avif_to_jpg:
-                            in_files_list.append(os.path.join(dirpath, name))
-                        else:
-                            convert_the_image = True
-                    elif name.lower().endswith((b'.jxl')):
-                        if args.no_jxl_to_jpg:
-                            in_files_list.append(os.path.join(dirpath, name))
-                        else:
-                            convert_the_image = True
-                    if convert_the_image:
-                        # Let ImageMagick convert the file to JPG
-                        jpg_of_other_filename = tempdir_filename()
-                        cmd = [ 'magick', os.path.join(dirpath, name),
-                               '-background', 'white', '-alpha', 'remove',
-                               '-quality', '90', '-colorspace', 'YUV',
-                               '-define', 'jpeg:dct-method=float',
-                               '-define', 'jpeg:optimize-coding=on',
-                               '-strip', '-auto-orient',
-                               jpg_of_other_filename ]
-                        executor.submit(exec_cmd, cmd)
-                        in_files_list.append(jpg_of_other_filename)
-
-    if not args.dry:
-        # Create PDF
+    pending_pages = []
+    with futures.ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        for pdf_path, label, pages, signature in pending_groups:
+            pending_pages.append([ convert_page(executor, cache_root, page) for page in pages ])
+    pending_pages = [ [ page.result() if isinstance(page, futures.Future) else page for page in pages ]
+                      for pages in pending_pages ]
+
+    # Create PDFs
+    if len(pending_groups) == 1 and not args.split:
         print("Creating actual PDF file.")
-        with open(out_file, "wb") as outfhandle:
-            if args.b5pagesize:
-                b5inpt = (img2pdf.mm_to_pt(176), img2pdf.mm_to_pt(250))
-            else:
-                b5inpt = (img2pdf.mm_to_pt(176), None)
-            layout_fun = img2pdf.get_layout_fun(pagesize=b5inpt, auto_orient=True)
-            outfhandle.write(img2pdf.convert(in_files_list, with_pdfrw=False, rotation=img2pdf.Rotation.ifvalid, layout_fun=layout_fun))
+        create_pdf(pending_pages[0], out_file, args.b5pagesize, not args.no_dedupe, args.object_streams, args.linearize)
+    elif pending_groups:
+        print("Creating {} PDF files.".format(len(pending_groups)))
+        with pdf_executor(args.max_workers) as pdfexecutor:
+            pdf_tasks = {}
+            for (pdf_path, label, pages, signature), page_files in zip(pending_groups, pending_pages):
+                task = pdfexecutor.submit(create_pdf, page_files, pdf_path, args.b5pagesize,
+                                          not args.no_dedupe, args.object_streams, args.linearize)
+                pdf_tasks[task] = (pdf_path, label, signature)
+
+            for task in futures.as_completed(pdf_tasks):
+                pdf_path, label, signature = pdf_tasks[task]
+                pdf_name = os.fsdecode(os.path.basename(pdf_path))
+                try:
+                    task.result()
+                except Exception as e:
+                    print("Creating {} failed: {}".format(pdf_name, e))
+                    failed_pdfs += 1
+                    continue
+                print("  Created " + pdf_name)
+                index["pdfs"][pdf_name] = { "label": label, "pages": signature }
+    else:
+        print("All PDF files are up to date.")
+
+    # measurements of complete runs calibrate the estimates of --plan
+    if pending_groups and not cached_pages and not failed_pdfs:
+        plan, formats = plan_pages([ page for pdf_path, label, pages, signature in pending_groups for page in pages ], None)
+        if plan["units"] > 0:
+            save_calibration({ "units": plan["units"],
+                               "cpu_time": cpu_time() - started_cpu_time,
+                               "slot_time": (time.monotonic() - started_at) * min(args.max_workers, os.cpu_count()),
+                               "in_bytes": plan["in_bytes"],
+                               "out_bytes": sum(os.path.getsize(pdf_path) for pdf_path, label, pages, signature in pending_groups) })
+
+if args.split:
+    # drop PDFs that no longer exist in the input
+    current_names = { os.fsdecode(os.path.basename(pdf_path)) for pdf_path, label, pages in pdf_groups }
+    index["pdfs"] = { name: entry for name, entry in index["pdfs"].items() if name in current_names }
+    # PDFs of groups that shifted would otherwise stay around next to the ones that replace them
+    for name in set(previous_pdfs) - current_names:
+        if name != os.path.basename(name):
+            continue
+        try:
+            os.remove(os.path.join(os.path.dirname(out_file), os.fsencode(name)))
+            print("  Removed outdated " + name)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print("Unable to remove {}: {}".format(name, e))
+    with open(index_file, "w") as indexfhandle:
+        json.dump(index, indexfhandle, indent=1)
+
+if not args.no_cache:
+    evict_cache(os.fsencode(args.cache_dir), args.cache_size)
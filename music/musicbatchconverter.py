@@ -14,8 +14,33 @@ import tempfile
 import random
 import string
 import re
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import json
+import copy
+import collections
+import functools
+import threading
+import signal
+import platform
+import hashlib
 from concurrent import futures
 
+def run_measured(cmd, output=None) -> subprocess.CompletedProcess:
+    # wait4 reports the CPU time of exactly this child, even while other threads run conversions
+    process = subprocess.Popen(cmd, shell=False, stdout=output, stderr=subprocess.STDOUT)
+    stdout = process.stdout.read() if process.stdout else None
+    pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.stdout:
+        process.stdout.close()
+    result = subprocess.CompletedProcess(cmd, process.returncode, stdout)
+    result.cpu_time = rusage.ru_utime + rusage.ru_stime
+    return result
+
 def exec_cmd(cmd, output=None):
     if isinstance(cmd, str):
         cmd = cmd.split(' ')
@@ -32,12 +57,63 @@ def exec_cmd(cmd, output=None):
         cmd.insert(1, "-n19")
         if args.v:
             print("  Executing command: {}".format(cmd))
-        return subprocess.run(cmd, shell=False, stdout=output, stderr=subprocess.STDOUT)
+        return run_measured(cmd, output)
     else:
         if args.v:
             print("  Executing command: {}".format(cmd))
         return subprocess.run(cmd, shell=False, stdout=output, stderr=subprocess.STDOUT)
 
+# Functions for watching the input directory with inotify
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+_inotify_event = struct.Struct('iIII')
+
+def inotify_init():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return libc, fd
+
+def inotify_watch_tree(libc, fd: int, root: Path, watches: dict) -> list:
+    '''
+    Watches root and all directories below it.
+    @returns list of files found in these directories
+    '''
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        wd = libc.inotify_add_watch(fd, os.fsencode(dirpath), IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd < 0:
+            print("Unable to watch directory {}: {}".format(dirpath, os.strerror(ctypes.get_errno())))
+            continue
+        watches[wd] = dirpath
+        found.extend(Path(dirpath, name) for name in sorted(filenames))
+    return found
+
+def inotify_read(fd: int, timeout: float) -> list:
+    '''
+    @returns list of (watch descriptor, mask, name) that occurred within timeout seconds
+    '''
+    ready, _, _ = select.select([ fd ], [], [], timeout)
+    if not ready:
+        return []
+    data = os.read(fd, 64 * 1024)
+    events = []
+    offset = 0
+    while offset < len(data):
+        wd, mask, cookie, length = _inotify_event.unpack_from(data, offset)
+        offset += _inotify_event.size
+        events.append((wd, mask, os.fsdecode(data[offset:offset + length].rstrip(b'\0'))))
+        offset += length
+    return events
+
 def random_string(length: int) -> str:
     chars = string.ascii_uppercase
     rnd_str = ""
@@ -45,37 +121,104 @@ def random_string(length: int) -> str:
         rnd_str += random.choice(chars)
     return rnd_str
 
-def make_fat32_compatible(file_path: Path) -> Path:
-    # Define a regular expression pattern for illegal characters
-    illegal_chars_pattern = re.compile(r'[<>:"/\\|?*\u0000-\u001F\u007F-\u009F]')
+# Functions for mapping paths to names that FAT32 accepts
+_fat32_illegal_chars = re.compile(r'[<>:"/\\|?*\u0000-\u001F\u007F-\u009F]')
+_fat32_astral_chars = re.compile('[\U00010000-\U0010FFFF]')
+_fat32_suffix = re.compile(r'\.\w{1,8}$')
+_fat32_names = {}
+_fat32_owners = {}
+_fat32_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def fat32_table() -> dict:
+    # built on first use for every character of the BMP that has to be replaced or dropped
+    table = {}
+    for codepoint in range(0x10000):
+        char = chr(codepoint)
+        if _fat32_illegal_chars.match(char):
+            table[codepoint] = '_'
+        elif unicodedata.category(char) in ('Mn', 'Me', 'Cf', 'Cc'):
+            # Ignore combining, enclosing, formatting, and control characters
+            table[codepoint] = None
+    return table
 
-    # Replace any illegal characters and unsupported Unicode characters with valid ones
-    fat32_compatible_path = []
+def fit_fat32_name(stem: str, suffix: str) -> str:
+    # long names on FAT32 hold at most 255 UTF-16 code units, the suffix is kept if the name is too long
+    while stem and len((stem + suffix).encode('utf-16-le', 'surrogatepass')) > 255 * 2:
+        stem = stem[:-1]
+    return (stem + suffix)[:255]
 
-    # Evaluate each blob of the path
-    for element in file_path.parts:
-        if element == file_path.anchor:
+def fat32_name(parent: tuple, element: str) -> str:
+    '''
+    Maps one component of a path. Components that would end up with the same name on FAT32,
+    which ignores case, get a hash of their original name appended.
+    '''
+    # Ignore characters beyond the BMP
+    name = _fat32_astral_chars.sub('', element.translate(fat32_table()))
+    # FAT32 drops trailing dots and spaces by itself
+    name = name.strip().rstrip('. ') or '_'
+    suffix_match = _fat32_suffix.search(name)
+    suffix = suffix_match.group() if suffix_match and suffix_match.start() > 0 else ''
+    name = fit_fat32_name(name[:len(name) - len(suffix)], suffix)
+
+    owner = _fat32_owners.setdefault((parent, name.casefold()), element)
+    if owner != element:
+        tag = "~" + hashlib.sha1(element.encode('utf-8', 'surrogateescape')).hexdigest()[:6]
+        name = fit_fat32_name(name[:len(name) - len(suffix)], tag + suffix)
+        _fat32_owners.setdefault((parent, name.casefold()), element)
+    _fat32_names[(parent, element)] = name
+    return name
+
+def make_fat32_compatible(root: Path, file_path: Path) -> Path:
+    '''
+    Maps the part of file_path below root to a path that FAT32 accepts. root is used as given.
+    Mapped components are remembered, so that deep trees are only sanitized once and every name
+    keeps its mapping for the whole run.
+    '''
+    fat32_compatible_path = list(root.parts)
+    for element in file_path.relative_to(root).parts:
+        if element in ('.', '..'):
             fat32_compatible_path.append(element)
-        else:
-            element_str = ""
-            for char in element:
-                if illegal_chars_pattern.match(char):
-                    element_str += '_'
-                elif unicodedata.category(char) in ['Mn', 'Me', 'Cf', 'Cc']:
-                    # Ignore combining, enclosing, formatting, and control characters
-                    pass
-                elif ord(char) > 0xFFFF:
-                    # Ignore characters beyond the BMP
-                    pass
-                else:
-                    element_str += char
-
-            # Ensure that the resulting path doesn't exceed the maximum length limit of FAT32
-            element_str = element_str.strip()[:255]
-            fat32_compatible_path.append(element_str)
+            continue
+        parent = tuple(fat32_compatible_path)
+        name = _fat32_names.get((parent, element))
+        if name is None:
+            with _fat32_lock:
+                name = _fat32_names.get((parent, element)) or fat32_name(parent, element)
+        fat32_compatible_path.append(name)
 
     return Path(*fat32_compatible_path)
 
+fat32_names_file = Path(os.environ.get("XDG_CACHE_HOME", Path.home().joinpath(".cache")), "pymediascripts", "fat32", "musicbatchconverter.json")
+
+def load_fat32_names():
+    '''
+    Restores which source name owns which FAT32 name, so that a name that got a suffix on an earlier run
+    keeps it even if a new colliding name is found first.
+    '''
+    try:
+        with open(fat32_names_file, "r") as fatfhandle:
+            owners = json.load(fatfhandle)
+    except (OSError, ValueError):
+        return
+    for parent, names in owners.items():
+        for name, element in names.items():
+            _fat32_owners[(Path(parent).parts, name)] = element
+
+def save_fat32_names():
+    owners = {}
+    with _fat32_lock:
+        for (parent, name), element in _fat32_owners.items():
+            owners.setdefault(str(Path(*parent)), {})[name] = element
+    try:
+        fat32_names_file.parent.mkdir(parents=True, exist_ok=True)
+        partial_file = fat32_names_file.with_suffix(".{}.json".format(os.getpid()))
+        with open(partial_file, "w") as fatfhandle:
+            json.dump(owners, fatfhandle)
+        os.replace(partial_file, fat32_names_file)
+    except OSError as e:
+        print("Unable to store FAT32 names: {}".format(e))
+
 # Argument custom validators
 def remove_empty_from_list(li):
     try:
@@ -175,12 +318,23 @@ try:
 
     Using a custom ffmpeg version from a container
     ./musicbatchconverter.py -v -ffpath "podman run --rm -v $PWD:/temp/ zennoe/ffmpeg-docker-ost" /temp/music-album /temp/out
+
+    Many albums in one go, sharing one pool of converters:
+    ./musicbatchconverter.py --batch jobs.toml
+
+    where jobs.toml lists the jobs with the long names of their options:
+    [[job]]
+    input_dir = "music-album"
+    output_dir = "/phone/music-album"
+    preset = "smaller"
+    fat32-compatible = true
     ''')
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=descrp)
 
-    parser.add_argument("input_dir", type=Path, help="path to input folder. Use \\ or \" for names with spaces")
-    parser.add_argument("output_dir", type=Path, help="output folder. Use \\ or \" for names with spaces")
+    parser.add_argument("input_dir", type=Path, nargs='?', help="path to input folder. Use \\ or \" for names with spaces")
+    parser.add_argument("output_dir", type=Path, nargs='?', help="output folder. Use \\ or \" for names with spaces")
+    parser.add_argument("--batch", type=Path, help="TOML or JSON file with a list of jobs, each with its own input_dir, output_dir and options. Options given on the command line apply to all jobs. All jobs share one pool of converters.")
     parser.add_argument("--ignore-dir", type=Path, help="Ignore directory with the specified folder name.")
     parser.add_argument("--ignore-not-empty", action="store_true", help="continue even if the output directory contains files. This overwrites existing files.")
     parser.add_argument("-ifm", "--inputfilemask", dest="ifm", default="flac,wav,aif,aiff,ape,dsd,mp3,ogg,opus,mka,m4a,wma,mp4,aac,mod", type=argcheck_ifm, help="Filter mask defining which files will be converted. Other files are copied")
@@ -196,7 +350,12 @@ try:
     parser.add_argument("-fat", "--fat32-compatible", dest="fat", help="Ensure that paths and filenames are compliant with FAT32 filesystems", action="store_true")
     parser.add_argument("--no-extract-coverart", dest="nocover", help="Skip the extraction of cover art from metadata", action="store_true")
     parser.add_argument("--always-extract-coverart", dest="alwayscover", help="Always extract cover art from metadata even if existing cover art was found", action="store_true")
+    parser.add_argument("--no-split-cue", dest="nocue", help="Convert disc images that come with a CUE sheet as one file instead of splitting them into their tracks.", action="store_true")
     parser.add_argument("--no-copy", dest="nocopy", help="Skip copying non-music files over. Usually all non-converted files are preserved. But setting this option, skips that step.", action="store_true")
+    parser.add_argument("--watch", help="Keep running after the initial conversion and convert new or changed files as soon as they stopped changing. Files whose output is newer than their source are skipped. Linux only.", action="store_true")
+    parser.add_argument("--settle-time", dest="settle_time", default=10.0, type=float, help="Seconds a file must not have changed before it is converted in --watch mode.")
+    parser.add_argument("--fingerprint-file", dest="fingerprint_file", type=Path, help="File that remembers the audio of converted files, so that files whose tags changed are only remuxed. Defaults to $XDG_CACHE_HOME/pymediascripts/fingerprints/musicbatchconverter.json")
+    parser.add_argument("--plan", help="Do not convert anything. Count the files that would be converted, copied or skipped, probe their duration and estimate run time and output size from earlier runs with the same options on this host.", action="store_true")
 
     args = parser.parse_args()
 
@@ -204,86 +363,141 @@ except Exception as e:
     print(e)
     exit(-1)
 
-# Check for runtime dependencies
-try:
-    subprocess.call([ Path(args.ffpath), "-version" ], stdout=subprocess.PIPE, shell=False)
+def job_to_argv(job: dict) -> list:
+    # options of a job in the batch file are named like the long command line options
+    argv = []
+    for key, value in job.items():
+        if key in ("input_dir", "output_dir"):
+            continue
+        option = "--" + key.replace('_', '-')
+        if value is True:
+            argv.append(option)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, list):
+            argv.append("{}={}".format(option, ",".join(str(el) for el in value)))
+        else:
+            argv.append("{}={}".format(option, value))
+    argv.extend([ str(job["input_dir"]), str(job["output_dir"]) ])
+    return argv
 
-except (subprocess.SubprocessError, FileNotFoundError):
-    print("This uses the `ffmpeg` command. You need to make sure that ffmpeg and its dependent codec libraries are installed.")
-    print("If you have tried to use `-ffpath` make sure it points to the executable.")
-    exit(-1)
+def load_batch_jobs(batch_path: Path) -> list:
+    '''
+    Reads the jobs of a batch file.
+    @returns list of argument namespaces, one per job
+    '''
+    if batch_path.suffix.lower() == ".toml":
+        import tomllib
+        with open(batch_path, "rb") as batchfhandle:
+            batch = tomllib.load(batchfhandle)
+    else:
+        with open(batch_path, "r") as batchfhandle:
+            batch = json.load(batchfhandle)
+    if isinstance(batch, dict):
+        batch = batch.get("job", batch.get("jobs", []))
 
-if not args.ignore_not_empty and args.output_dir.exists() and len(os.listdir(args.output_dir)) > 0:
-    print("Your output directory is not empty. If you continue using --ignore-not-empty existing files may be overwritten")
-    exit(-1)
+    jobs = []
+    for job in batch:
+        if "input_dir" not in job or "output_dir" not in job:
+            print("Every job needs an input_dir and an output_dir: {}".format(job))
+            exit(-1)
+        # the command line arguments serve as defaults of every job
+        jobs.append(parser.parse_args(job_to_argv(job), namespace=copy.deepcopy(args)))
+    return jobs
 
-if not args.ffargs and not args.preset:
-    print("You neither selected a preset nor set any ffmpeg arguments. Selecting the compatible preset for you...")
-    args.preset = 2
-
-# apply preset
-if args.preset == 1:
-    # smaller
-    args.ofm = argcheck_ofm("ogg")
-    args.ffargs = argcheck_ffargs("-c:a libopus -b:a 160k -vbr 2 -ac 2")
-
-if args.preset == 2:
-    # compatible
-    pop_element_from_list(args.ifm, "mp3")
-    args.ofm = argcheck_ofm("mp3")
-    if not args.ffargs:
-        args.ffargs = argcheck_ffargs("-c:a libmp3lame -q:a 1 -compression_level 0 -ac 2")
-
-if args.preset == 3:
-    # dynamic_compressed
-    args.ofm = argcheck_ofm("mka")
-    args.ffargs = argcheck_ffargs("-map 0:a -ac 2 -c copy" +
-                                  " -c:a libopus -b:a 192k -vbr 2" +
-                                  " -metadata REPLAYGAIN_ALBUM_GAIN=0 -metadata REPLAYGAIN_ALBUM_PEAK=0.99" +
-                                  " -metadata REPLAYGAIN_TRACK_GAIN=0 -metadata REPLAYGAIN_TRACK_PEAK=0.99" +
-                                  " -af aresample=osf=flt:osr=192000:filter_type=kaiser,dynaudnorm=r=-18dB")
-if args.preset == 4:
-    # normalized
-    args.ofm = argcheck_ofm("mka")
-    args.ffargs = argcheck_ffargs("-map 0:a -ac 2 -c copy" +
-                                  " -c:a libopus -b:a 192k -vbr 2" +
-                                  " -metadata REPLAYGAIN_ALBUM_GAIN=0 -metadata REPLAYGAIN_ALBUM_PEAK=0.99" +
-                                  " -metadata REPLAYGAIN_TRACK_GAIN=0 -metadata REPLAYGAIN_TRACK_PEAK=0.99" +
-                                  " -af aresample=osf=flt:osr=192000:filter_type=kaiser,alimiter=limit=-1.0dB:level=off:attack=2:release=50:level_in=")
-
-if args.preset == 6:
-    # mp4walkman
-    args.ofm = argcheck_ofm("mp4")
-    if not args.ffargs:
-        args.ffargs = argcheck_ffargs("-map 0:a -c:a libfdk_aac -vbr 4 -profile:a aac_low -ac 2 -af aresample=osr=44100:resampler=swr:filter_type=kaiser")
-
-if args.preset == 10:
-    # CD-Wav
-    args.ofm = argcheck_ofm("wav")
-    if not args.ffargs:
-        # for limiting after resampling -0.25dB would suffice. but when limiting pre resample -1dB is just quiet enough
-        args.ffargs = argcheck_ffargs("-c:a pcm_s16le -af aresample=osf=flt:osr=44100:resampler=swr:filter_type=kaiser,alimiter=limit=-0.1dB:level=off:attack=2.5:release=15,aresample=osf=s16:dither_method=triangular_hp")
-
-if args.preset == 11:
-    # Flac
-    pop_element_from_list(args.ifm, "flac")
-    args.ofm = argcheck_ofm("flac")
-    if not args.ffargs:
-        args.ffargs = argcheck_ffargs("-c:a flac -compression_level 8")
-
-if args.preset == 12:
-    # CD-Flac
-    args.ofm = argcheck_ofm("flac")
-    # downsampling can cause clipping, so limiting is applied before converting back to 16bit
-    args.ffargs = argcheck_ffargs("-c:a flac -compression_level 8 -af aresample=osf=flt:osr=44100:resampler=swr:filter_type=kaiser,alimiter=limit=-0.1dB:level=off:attack=2.5:release=15,aresample=osf=s16:dither_method=triangular_hp")
-
-def extract_coverart(in_filepath: Path, tempdir: Path) -> Path:
+def prepare_job(job) -> bool:
+    '''
+    Applies the preset of a job.
+    @returns False if the job cannot run
+    '''
+    if not job.ignore_not_empty and not job.watch and not job.plan and job.output_dir.exists() and len(os.listdir(job.output_dir)) > 0:
+        print("Your output directory {} is not empty. If you continue using --ignore-not-empty existing files may be overwritten".format(job.output_dir))
+        return False
+
+    if not job.ffargs and not job.preset:
+        print("You neither selected a preset nor set any ffmpeg arguments. Selecting the compatible preset for you...")
+        job.preset = 2
+
+    apply_preset(job)
+
+    if job.fat:
+        # the owners of FAT32 names are remembered by their parent, which has to be the same from any working directory
+        job.output_dir = job.output_dir.absolute()
+
+    # if you passed ignore_not_empty, we don't want to run into a loop and reconvert music we already converted
+    if job.input_dir.resolve() == job.output_dir.resolve():
+        pop_element_from_list(job.ifm, job.ofm)
+
+    # files of a job are queued here and handed to the shared converters in turns
+    job.queue = collections.deque()
+    job.stats = collections.Counter()
+    job.started_at = time.monotonic()
+    job.finished_at = job.started_at
+    return True
+
+def apply_preset(job):
+    if job.preset == 1:
+        # smaller
+        job.ofm = argcheck_ofm("ogg")
+        job.ffargs = argcheck_ffargs("-c:a libopus -b:a 160k -vbr 2 -ac 2")
+
+    if job.preset == 2:
+        # compatible
+        pop_element_from_list(job.ifm, "mp3")
+        job.ofm = argcheck_ofm("mp3")
+        if not job.ffargs:
+            job.ffargs = argcheck_ffargs("-c:a libmp3lame -q:a 1 -compression_level 0 -ac 2")
+
+    if job.preset == 3:
+        # dynamic_compressed
+        job.ofm = argcheck_ofm("mka")
+        job.ffargs = argcheck_ffargs("-map 0:a -ac 2 -c copy" +
+                                     " -c:a libopus -b:a 192k -vbr 2" +
+                                     " -metadata REPLAYGAIN_ALBUM_GAIN=0 -metadata REPLAYGAIN_ALBUM_PEAK=0.99" +
+                                     " -metadata REPLAYGAIN_TRACK_GAIN=0 -metadata REPLAYGAIN_TRACK_PEAK=0.99" +
+                                     " -af aresample=osf=flt:osr=192000:filter_type=kaiser,dynaudnorm=r=-18dB")
+    if job.preset == 4:
+        # normalized
+        job.ofm = argcheck_ofm("mka")
+        job.ffargs = argcheck_ffargs("-map 0:a -ac 2 -c copy" +
+                                     " -c:a libopus -b:a 192k -vbr 2" +
+                                     " -metadata REPLAYGAIN_ALBUM_GAIN=0 -metadata REPLAYGAIN_ALBUM_PEAK=0.99" +
+                                     " -metadata REPLAYGAIN_TRACK_GAIN=0 -metadata REPLAYGAIN_TRACK_PEAK=0.99" +
+                                     " -af aresample=osf=flt:osr=192000:filter_type=kaiser,alimiter=limit=-1.0dB:level=off:attack=2:release=50:level_in=")
+
+    if job.preset == 6:
+        # mp4walkman
+        job.ofm = argcheck_ofm("mp4")
+        if not job.ffargs:
+            job.ffargs = argcheck_ffargs("-map 0:a -c:a libfdk_aac -vbr 4 -profile:a aac_low -ac 2 -af aresample=osr=44100:resampler=swr:filter_type=kaiser")
+
+    if job.preset == 10:
+        # CD-Wav
+        job.ofm = argcheck_ofm("wav")
+        if not job.ffargs:
+            # for limiting after resampling -0.25dB would suffice. but when limiting pre resample -1dB is just quiet enough
+            job.ffargs = argcheck_ffargs("-c:a pcm_s16le -af aresample=osf=flt:osr=44100:resampler=swr:filter_type=kaiser,alimiter=limit=-0.1dB:level=off:attack=2.5:release=15,aresample=osf=s16:dither_method=triangular_hp")
+
+    if job.preset == 11:
+        # Flac
+        pop_element_from_list(job.ifm, "flac")
+        job.ofm = argcheck_ofm("flac")
+        if not job.ffargs:
+            job.ffargs = argcheck_ffargs("-c:a flac -compression_level 8")
+
+    if job.preset == 12:
+        # CD-Flac
+        job.ofm = argcheck_ofm("flac")
+        # downsampling can cause clipping, so limiting is applied before converting back to 16bit
+        job.ffargs = argcheck_ffargs("-c:a flac -compression_level 8 -af aresample=osf=flt:osr=44100:resampler=swr:filter_type=kaiser,alimiter=limit=-0.1dB:level=off:attack=2.5:release=15,aresample=osf=s16:dither_method=triangular_hp")
+
+def extract_coverart(job, in_filepath: Path, tempdir: Path) -> Path:
     '''
     @params
     @returns path_to_coverart
     '''
 
-    if not args.alwayscover:
+    if not job.alwayscover:
         # search for coverart in parent folder
         # the order of these names is respected and represents priorities
         iter_coverart_names = ('folder.jpg', 'folder.png',
@@ -300,34 +514,296 @@ def extract_coverart(in_filepath: Path, tempdir: Path) -> Path:
     # extract coverart from source if possible
     if in_filepath.exists() :
         cpath = Path(tempdir).joinpath(random_string(20) + '.jpg')
-        cmd = [ Path(args.ffpath), '-y', '-i', Path(in_filepath) ]
+        cmd = [ Path(job.ffpath), '-y', '-i', Path(in_filepath) ]
         cmd.extend(["-map", "0:v", "-q:v", "5", cpath])
-        if not args.vff:
+        if not job.vff:
             cmd.extend([ '-loglevel', 'fatal' ])
         if exec_cmd(cmd).returncode == 0:
             return cpath
 
     return None
 
-def copy_file(in_filepath: Path, out_filepath: Path) -> Path:
-    if args.fat:
-        out_filepath = make_fat32_compatible(out_filepath)
+# Functions for splitting disc images along their CUE sheet
+CueTrack = collections.namedtuple('CueTrack', ['number', 'start', 'end', 'tags'])
+
+def read_cue_sheet(cue_path: Path) -> dict:
+    '''
+    Reads the tracks of a CUE sheet. Files with a single track are left alone.
+    @returns dict of the stems of the referenced audio files with their list of tracks
+    '''
+    data = cue_path.read_bytes()
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        # older rippers write the codepage of the system
+        text = data.decode('cp1252', errors='replace')
+
+    album = {}
+    files = {}
+    tracks = None
+    track = None
+    for line in text.splitlines():
+        match = re.match(r'\s*(?:REM\s+)?(\w+)\s+(?:"([^"]*)"|(\S+))(.*)$', line)
+        if not match:
+            continue
+        command = match.group(1).upper()
+        value = match.group(2) if match.group(2) is not None else match.group(3)
+        if command == "FILE":
+            tracks = files.setdefault(Path(value.replace('\\', '/')).stem, [])
+            track = None
+        elif command == "TRACK" and tracks is not None:
+            track = { "number": int(value), "start": None }
+            tracks.append(track)
+        elif command == "INDEX" and track is not None and int(value) == 1:
+            # positions are given in minutes, seconds and frames of 1/75s
+            position = match.group(4).split()
+            if not position:
+                raise ValueError("INDEX 01 of track {} has no position".format(track["number"]))
+            minutes, seconds, frames = position[0].split(':')
+            track["start"] = int(minutes) * 60 + int(seconds) + int(frames) / 75
+        elif command in ("TITLE", "PERFORMER", "SONGWRITER", "DATE", "GENRE"):
+            (track if track is not None else album)[command] = value
+
+    cue_tracks = {}
+    for stem, tracks in files.items():
+        if len(tracks) < 2 or any(track["start"] is None for track in tracks):
+            continue
+        cue_tracks[stem] = []
+        for index, track in enumerate(tracks):
+            # pregaps stay with the previous track, just like on the disc
+            end = tracks[index + 1]["start"] if index + 1 < len(tracks) else None
+            tags = { "title": track.get("TITLE"),
+                     "artist": track.get("PERFORMER", album.get("PERFORMER")),
+                     "composer": track.get("SONGWRITER", album.get("SONGWRITER")),
+                     "album": album.get("TITLE"),
+                     "album_artist": album.get("PERFORMER"),
+                     "date": album.get("DATE"),
+                     "genre": album.get("GENRE"),
+                     "track": "{}/{}".format(track["number"], len(tracks)) }
+            tags = { key: value for key, value in tags.items() if value }
+            # an embedded CUE sheet of the image is meaningless for a single track
+            tags["cuesheet"] = ""
+            cue_tracks[stem].append(CueTrack(track["number"], track["start"], end, tags))
+    return cue_tracks
+
+def find_cue_tracks(job, dirpath: str, name: str) -> list:
+    '''
+    Looks for a CUE sheet next to an audio file that splits it into tracks.
+    @returns list of CueTrack or None
+    '''
+    # CUE sheets are read once per directory, except in watch mode where they may change
+    if job.watch or dirpath not in cue_sheets:
+        cue_sheets[dirpath] = {}
+        for cue_path in sorted(Path(dirpath).glob("*.[cC][uU][eE]")):
+            try:
+                cue_sheets[dirpath].update(read_cue_sheet(cue_path))
+            except (OSError, ValueError) as e:
+                print("  Unable to read CUE sheet {}: {}".format(cue_path, e))
+    return cue_sheets[dirpath].get(Path(name).stem)
+
+def split_image(tracks: list, split_done: futures.Future, job, in_filepath: Path, split_dir: Path):
+    '''
+    Decodes a disc image once and writes each of its tracks losslessly to split_dir.
+    '''
+    try:
+        split_dir.mkdir(parents=True, exist_ok=True)
+        cmd = [ Path(job.ffpath), '-y', '-i', Path(in_filepath) ]
+        if not job.vff:
+            cmd.extend([ '-loglevel', 'error' ])
+        for track in tracks:
+            trim = "atrim=start={:.6f}".format(track.start)
+            if track.end is not None:
+                trim += ":end={:.6f}".format(track.end)
+            # every output cuts its track from the same decoded audio
+            cmd.extend([ '-map', '0:a', '-af', trim + ",asetpts=PTS-STARTPTS",
+                         '-c:a', 'flac', '-compression_level', '0', Path(split_dir, "{:02d}.flac".format(track.number)) ])
+        if exec_cmd(cmd).returncode != 0:
+            raise RuntimeError("ffmpeg failed to split {}".format(in_filepath))
+    except Exception as e:
+        split_done.set_exception(e)
+        raise
+    split_done.set_result(split_dir)
+
+def convert_track(track: CueTrack, job, in_filepath: Path, out_filepath: Path):
+    try:
+        convert_file(job, in_filepath, out_filepath, track.tags)
+    finally:
+        in_filepath.unlink(missing_ok=True)
+
+def submit_tracks(job, tracks: list, out_filepaths: list, split_done: futures.Future):
+    # tracks only take up a converter once their disc image is split, a failed split is already reported
+    if split_done.exception() is not None:
+        return
+    split_dir = split_done.result()
+    try:
+        for track, out_filepath in zip(tracks, out_filepaths):
+            submit_task(job, "convert", functools.partial(convert_track, track),
+                        Path(split_dir, "{:02d}.flac".format(track.number)), out_filepath)
+    except RuntimeError:
+        # the watch was stopped while splitting, the tracks are picked up again by the next run
+        shutil.rmtree(split_dir, ignore_errors=True)
+
+def queue_cue_tracks(job, in_filepath: Path, out_dirpath: Path, tracks: list):
+    out_filepaths = []
+    for track in tracks:
+        title = track.tags.get("title", in_filepath.stem).replace('/', '_').replace('\\', '_')
+        out_filepath = Path(out_dirpath, "{:02d} - {}.{}".format(track.number, title, job.ofm))
+        out_filepaths.append(make_fat32_compatible(job.output_dir, out_filepath) if job.fat else out_filepath)
+    if job.watch and all(is_up_to_date(in_filepath, out_filepath) for out_filepath in out_filepaths):
+        if args.v:
+            print("  Tracks of {} are up to date. Skipping".format(in_filepath))
+        return
+
+    if args.v:
+        print("  splitting {} into {} tracks".format(in_filepath.name, len(tracks)))
+    split_dir = Path(tempdir, random_string(20))
+    split_done = futures.Future()
+    split_done.add_done_callback(functools.partial(submit_tracks, job, tracks, out_filepaths))
+    job.queue.append(("split", functools.partial(split_image, tracks, split_done), in_filepath, split_dir))
+
+def is_up_to_date(in_filepath: Path, out_filepath: Path) -> bool:
+    # in watch mode files are only converted again when their source changed
+    try:
+        return out_filepath.stat().st_mtime >= in_filepath.stat().st_mtime
+    except OSError:
+        return False
+
+# Functions for telling apart changes of the audio from changes of the tags
+fingerprint_file = args.fingerprint_file or Path(os.environ.get("XDG_CACHE_HOME", Path.home().joinpath(".cache")), "pymediascripts", "fingerprints", "musicbatchconverter.json")
+
+def flac_audio_offset(fhandle) -> int:
+    # an ID3 tag in front of the FLAC stream is metadata as well
+    head = fhandle.read(10)
+    if head.startswith(b'ID3'):
+        fhandle.seek(10 + (head[6] << 21 | head[7] << 14 | head[8] << 7 | head[9]))
+    else:
+        fhandle.seek(0)
+    if fhandle.read(4) != b'fLaC':
+        return None
+    while True:
+        block_header = fhandle.read(4)
+        if len(block_header) < 4:
+            return None
+        fhandle.seek(int.from_bytes(block_header[1:4], 'big'), os.SEEK_CUR)
+        if block_header[0] & 0x80:
+            # the last metadata block is followed by the audio frames
+            return fhandle.tell()
+
+def audio_fingerprint(job, in_filepath: Path) -> str:
+    '''
+    Hashes the audio of in_filepath but none of its tags and pictures.
+    @returns hash or None if the audio cannot be told apart
+    '''
+    if in_filepath.suffix.lower() == ".flac":
+        digest = hashlib.sha256()
+        with open(in_filepath, "rb") as audiofhandle:
+            if flac_audio_offset(audiofhandle) is None:
+                return None
+            for chunk in iter(lambda: audiofhandle.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    # other containers interleave tags and audio, so let ffmpeg hash the audio packets without decoding them
+    cmd = [ Path(job.ffpath), '-i', Path(in_filepath), '-loglevel', 'error',
+            '-map', '0:a', '-c', 'copy', '-f', 'streamhash', '-hash', 'sha256', '-' ]
+    result = exec_cmd(cmd, output=subprocess.PIPE)
+    hashes = re.findall(rb"SHA256=([0-9a-f]+)", result.stdout or b"")
+    if result.returncode != 0 or not hashes:
+        return None
+    return str(b",".join(hashes), "ascii")
+
+def load_fingerprints() -> dict:
+    try:
+        with open(fingerprint_file, "r") as fpfhandle:
+            return json.load(fpfhandle)
+    except (OSError, ValueError):
+        return {}
+
+def store_fingerprint(out_filepath: Path, fingerprint: list):
+    global fingerprints_saved_at
+    with stats_lock:
+        fingerprints[str(out_filepath.resolve())] = fingerprint
+        if time.monotonic() - fingerprints_saved_at < 60:
+            return
+        fingerprints_saved_at = time.monotonic()
+    # a watch that gets killed instead of stopped only forgets the conversions of the last minute
+    save_fingerprints()
+
+def save_fingerprints():
+    try:
+        fingerprint_file.parent.mkdir(parents=True, exist_ok=True)
+        partial_file = fingerprint_file.with_suffix(".{}.json".format(os.getpid()))
+        with stats_lock, open(partial_file, "w") as fpfhandle:
+            json.dump(fingerprints, fpfhandle)
+        os.replace(partial_file, fingerprint_file)
+    except OSError as e:
+        print("Unable to store fingerprints: {}".format(e))
+
+# containers that ffmpeg can write an attached picture to
+picture_formats = ('mp3', 'm4a', 'mp4', 'mka', 'mkv', 'flac')
+
+def remux_metadata(job, in_filepath: Path, out_filepath: Path) -> bool:
+    '''
+    Replaces the tags of an already converted file with the ones of its source without encoding it again.
+    @returns False if ffmpeg failed
+    '''
+    partial_filepath = Path(out_filepath.parent, "." + random_string(8) + out_filepath.suffix)
+    cmd = [ Path(job.ffpath), '-y', '-i', Path(out_filepath), '-i', Path(in_filepath) ]
+    if not job.vff:
+        cmd.extend([ '-loglevel', 'error' ])
+    if job.ofm in picture_formats and '-vn' not in job.ffargs and '-map' not in job.ffargs:
+        # the picture of the source is a tag as well, so it replaces the one of the converted file
+        cmd.extend([ '-map', '0:a', '-map', '1:v?', '-disposition:v', 'attached_pic' ])
+    else:
+        cmd.extend([ '-map', '0' ])
+    cmd.extend([ '-map_metadata', '1', '-c', 'copy' ])
+    # tags set by the preset win over the ones of the source, just like during conversion
+    for index, arg in enumerate(job.ffargs[:-1]):
+        if arg == '-metadata':
+            cmd.extend([ '-metadata', job.ffargs[index + 1] ])
+    cmd.append(partial_filepath)
+    if exec_cmd(cmd).returncode != 0:
+        partial_filepath.unlink(missing_ok=True)
+        return False
+    os.replace(partial_filepath, out_filepath)
+    return True
+
+def copy_file(job, in_filepath: Path, out_filepath: Path) -> Path:
+    if job.watch and is_up_to_date(in_filepath, out_filepath):
+        return
 
     shutil.copyfile(in_filepath, out_filepath, follow_symlinks=False)
 
-def convert_file(in_filepath: Path, out_filepath: Path) -> Path:
-    if args.fat:
-        out_filepath = make_fat32_compatible(out_filepath)
+def convert_file(job, in_filepath: Path, out_filepath: Path, metadata: dict = None) -> Path:
+    if job.watch and is_up_to_date(in_filepath, out_filepath):
+        if args.v:
+            print("  File {} is up to date. Skipping".format(out_filepath))
+        return
+
+    # tracks of disc images get their tags from the CUE sheet, so only whole files are fingerprinted
+    fingerprint = None
+    if metadata is None:
+        fingerprint = [ audio_fingerprint(job, in_filepath), job.ofm, " ".join(job.ffargs) ]
+        if fingerprint[0] is None:
+            fingerprint = None
+        elif out_filepath.exists() and fingerprints.get(str(out_filepath.resolve())) == fingerprint:
+            if args.v:
+                print("  Audio of {} is unchanged. Only updating the tags of {}".format(in_filepath, out_filepath))
+            if remux_metadata(job, in_filepath, out_filepath):
+                return
 
-    ffargs = args.ffargs
-    if args.preset == 4:
+    started_at = time.monotonic()
+    cpu_time = 0.0
+    ffargs = job.ffargs
+    if job.preset == 4:
         #TODO move this to somewhere else, not as a preset
         # for normalisation we need to analyse the audio first
-        cmd = [ Path(args.ffpath), '-y', '-i', Path(in_filepath) ]
+        cmd = [ Path(job.ffpath), '-y', '-i', Path(in_filepath) ]
 
         cmd.extend(["-map", "0:a", "-af", "ebur128", "-f", "wav"])
         cmd.append(os.devnull)
         ana_result = exec_cmd(cmd, output=subprocess.PIPE)
+        cpu_time += getattr(ana_result, "cpu_time", 0.0)
         ana_result = str(ana_result.stdout, "utf8")
         i_loudness = re.search(r"Integrated\sloudness\:\s+I\:\s+(\-\d+\.?\d*)", ana_result).groups()[0]
         i_loudrange = re.search(r"Loudness\srange\:\s+LRA\:\s+(\d+\.?\d*)", ana_result).groups()[0]
@@ -340,14 +816,390 @@ def convert_file(in_filepath: Path, out_filepath: Path) -> Path:
         gain_adjust = -18.0 - float(i_loudness)
         ffargs = argcheck_ffargs(" ".join(ffargs) + str(gain_adjust) + "dB")
 
-    cmd = [ Path(args.ffpath), '-y', '-i', Path(in_filepath) ]
-    if not args.vff:
-        cmd.extend([ '-loglevel', 'error' ])
+    cmd = [ Path(job.ffpath), '-y', '-i', Path(in_filepath) ]
+    if not job.vff:
+        # at the info level ffmpeg also reports the duration that calibrates --plan, only errors are shown though
+        cmd.extend([ '-hide_banner', '-nostats', '-loglevel', 'level+info' ])
     cmd.extend(ffargs)
+    for key, value in (metadata or {}).items():
+        cmd.extend([ '-metadata', "{}={}".format(key, value) ])
     cmd.append(Path(out_filepath))
-    exec_cmd(cmd)
+    result = exec_cmd(cmd, output=None if job.vff else subprocess.PIPE)
+    for line in str(result.stdout or b"", "utf8", errors="replace").splitlines():
+        if re.search(r"\[(error|fatal|panic)\]", line):
+            print(line)
+    duration = parse_duration(result.stdout)
+    if result.returncode != 0:
+        raise RuntimeError("ffmpeg failed to convert {}".format(in_filepath))
+    if fingerprint is not None:
+        store_fingerprint(out_filepath, fingerprint)
+    record_conversion(job, in_filepath, out_filepath, duration, cpu_time + getattr(result, "cpu_time", 0.0), started_at)
+
+def output_dirpath(job, dirpath: str) -> Path:
+    '''
+    Creates the output directory matching dirpath.
+    @returns the output directory before it is made FAT32 compatible or None if dirpath is ignored
+    '''
+    ignore_dir = str(job.ignore_dir)
+    if ignore_dir != '.' and ignore_dir in dirpath:
+        # Skip directory that is meant to be ignored
+        return None
+
+    out_dirpath = Path(job.output_dir, Path(dirpath).relative_to(job.input_dir))
+    if not job.plan:
+        (make_fat32_compatible(job.output_dir, out_dirpath) if job.fat else out_dirpath).mkdir(parents=True, exist_ok=True)
+    return out_dirpath
+
+def queue_task(job, kind: str, fun, in_filepath: Path, out_filepath: Path):
+    # output paths are mapped here in the order of evaluation, so that colliding names are told apart the same way every run
+    if job.fat:
+        out_filepath = make_fat32_compatible(job.output_dir, out_filepath)
+    job.queue.append((kind, fun, in_filepath, out_filepath))
+
+def evaluate_file(job, dirpath: str, name: str, out_dirpath: Path):
+    in_filepath = Path(dirpath, name)
+    # Evaluate file
+    if name.lower().endswith(tuple(job.ifm)):
+        # estimates of --plan only need the duration, which is the same for a disc image and its tracks
+        tracks = None if job.nocue or job.plan else find_cue_tracks(job, dirpath, name)
+        if tracks:
+            queue_cue_tracks(job, in_filepath, out_dirpath, tracks)
+        else:
+            out_filepath = Path(out_dirpath, Path(name).stem + '.' + job.ofm)
+            queue_task(job, "convert", convert_file, in_filepath, out_filepath)
+        if not job.nocover and not job.plan and out_dirpath not in coverart_dirs:
+            coverpath = extract_coverart(job, in_filepath, tempdir)
+            if isinstance(coverpath, Path):
+                if args.v:
+                    print("  copying cover art " + str(coverpath) + " of " + str(name))
+                queue_task(job, "copy", copy_file, coverpath, Path(out_dirpath, "cover" + coverpath.suffix))
+                coverart_dirs.add(out_dirpath)
+    else:
+        if job.cfm == '*' or name.lower().endswith(tuple(job.cfm)) or job.nocopy:
+            with stats_lock:
+                job.stats["skipped"] += 1
+        else:
+            # Copy file to destination
+            if args.v:
+                print("  copying file: " + str(name))
+            queue_task(job, "copy", copy_file, in_filepath, Path(out_dirpath, name))
+
+def probe_duration(job, in_filepath: Path) -> float:
+    # without an output ffmpeg only prints what it found out about the input, which includes its duration
+    cmd = [ Path(job.ffpath), '-hide_banner', '-i', Path(in_filepath) ]
+    return parse_duration(exec_cmd(cmd, output=subprocess.PIPE).stdout)
+
+def parse_duration(output: bytes) -> float:
+    match = re.search(rb"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)", output or b"")
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def calibration_host() -> str:
+    '''
+    Names the hardware that estimates are measured on. Containers get a new hostname on every run,
+    so the CPU model and the number of cores are used unless PYMEDIASCRIPTS_CALIBRATION_HOST is set.
+    '''
+    host = os.environ.get("PYMEDIASCRIPTS_CALIBRATION_HOST")
+    if host:
+        return host
+    cpu_model = platform.processor() or platform.machine()
+    try:
+        with open("/proc/cpuinfo", "r") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("model name"):
+                    cpu_model = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return "{} x{}".format(cpu_model, os.cpu_count())
+
+def calibration_key(job) -> str:
+    # estimates only carry over to runs on the same hardware with the same conversion options
+    return "{} {} {}".format(calibration_host(), job.ofm, " ".join(job.ffargs))
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} TiB".format(size)
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}h {:02d}m {:02d}s".format(hours, minutes, seconds)
+
+calibration_file = Path(os.environ.get("XDG_CACHE_HOME", Path.home().joinpath(".cache")), "pymediascripts", "calibration", "musicbatchconverter.json")
+calibration_fields = ("units", "cpu_time", "slot_time", "in_bytes", "out_bytes")
+
+def load_calibration() -> dict:
+    try:
+        with open(calibration_file, "r") as calfhandle:
+            return json.load(calfhandle)
+    except (OSError, ValueError):
+        return {}
+
+def save_calibration(jobs: list):
+    calibration = load_calibration()
+    for job in jobs:
+        if job.stats["units"] <= 0:
+            continue
+        entry = calibration.setdefault(calibration_key(job), {})
+        for field in calibration_fields:
+            # older runs fade out so that the estimates follow new hardware and encoder versions
+            entry[field] = entry.get(field, 0.0) * 0.75 + job.stats[field]
+    try:
+        calibration_file.parent.mkdir(parents=True, exist_ok=True)
+        partial_file = calibration_file.with_suffix(".{}.json".format(os.getpid()))
+        with open(partial_file, "w") as calfhandle:
+            json.dump(calibration, calfhandle, indent=1)
+        os.replace(partial_file, calibration_file)
+    except OSError as e:
+        print("Unable to store calibration data: {}".format(e))
+
+def record_conversion(job, in_filepath: Path, out_filepath: Path, units: float, cpu_time: float, started_at: float):
+    # measurements of every converted file calibrate the estimates of --plan
+    if units is None or not out_filepath.exists():
+        return
+    with stats_lock:
+        job.stats["units"] += units
+        job.stats["cpu_time"] += cpu_time
+        job.stats["slot_time"] += time.monotonic() - started_at
+        job.stats["in_bytes"] += in_filepath.stat().st_size
+        job.stats["out_bytes"] += out_filepath.stat().st_size
+
+def plan_job(job, calibration: dict) -> float:
+    '''
+    Probes the queued files of a job instead of converting them and prints the estimates.
+    @returns estimated converter time in seconds or None without calibration data
+    '''
+    plan = collections.Counter()
+    formats = collections.Counter()
+    for kind, fun, in_filepath, out_filepath in job.queue:
+        if job.watch and is_up_to_date(in_filepath, out_filepath):
+            job.stats["skipped"] += 1
+            continue
+        size = in_filepath.stat().st_size
+        if kind == "copy":
+            plan["copy"] += 1
+            plan["copy_bytes"] += size
+            continue
+        plan["convert"] += 1
+        plan["in_bytes"] += size
+        formats[in_filepath.suffix.lower().lstrip('.')] += 1
+        units = probe_duration(job, in_filepath)
+        if units is None:
+            plan["unprobed_bytes"] += size
+        else:
+            plan["units"] += units
+            plan["probed_bytes"] += size
+    job.queue.clear()
+
+    entry = calibration.get(calibration_key(job))
+    # files that could not be probed are assumed to be like the others of similar size
+    if plan["unprobed_bytes"] and plan["probed_bytes"]:
+        plan["units"] += plan["unprobed_bytes"] * plan["units"] / plan["probed_bytes"]
+    elif plan["unprobed_bytes"] and entry:
+        plan["units"] += plan["unprobed_bytes"] * entry["units"] / entry["in_bytes"]
+
+    print("Plan for folder {} to folder {}".format(job.input_dir, job.output_dir))
+    print("  {} files to convert ({}, {} of audio), {} files to copy ({}), {} files skipped".format(
+          plan["convert"], format_size(plan["in_bytes"]), format_duration(plan["units"]),
+          plan["copy"], format_size(plan["copy_bytes"]), job.stats["skipped"]))
+    if formats:
+        print("  Formats to convert: " + ", ".join("{} {}".format(ending, count) for ending, count in formats.most_common()))
+    if not entry:
+        print("  No calibration data for these options on {} yet. Convert once to calibrate the estimates.".format(calibration_host()))
+        return None
+
+    slot_time = plan["units"] * entry["slot_time"] / entry["units"]
+    out_bytes = plan["units"] * entry["out_bytes"] / entry["units"] + plan["copy_bytes"]
+    print("  Estimated {} with {} workers, {} of CPU time, {} of output".format(
+          format_duration(slot_time / min(args.max_workers, os.cpu_count())), args.max_workers,
+          format_duration(plan["units"] * entry["cpu_time"] / entry["units"]), format_size(out_bytes)))
+    return slot_time
+
+def finish_task(job, kind: str, task: futures.Future):
+    with stats_lock:
+        if task.exception() is not None:
+            job.stats["failed"] += 1
+        else:
+            job.stats[kind] += 1
+        job.finished_at = time.monotonic()
+
+def submit_queued(jobs: list):
+    '''
+    Hands the queued files of all jobs to the shared executors, taking turns between jobs
+    so that every job makes progress instead of one job after the other.
+    '''
+    while any(job.queue for job in jobs):
+        for job in jobs:
+            if not job.queue:
+                continue
+            submit_task(job, *job.queue.popleft())
+
+def submit_task(job, kind: str, fun, in_filepath: Path, out_filepath: Path):
+    # split disc images submit their tracks from a converter thread, so the task sets are shared
+    if kind == "copy":
+        task = copyexecutor.submit(fun, job, in_filepath, out_filepath)
+        with tasks_lock:
+            copy_tasks.add(task)
+    else:
+        task = convertexecutor.submit(fun, job, in_filepath, out_filepath)
+        with tasks_lock:
+            convert_tasks.add(task)
+    task.add_done_callback(functools.partial(finish_task, job, kind))
+
+def wait_for_tasks(tasks: set, report=None):
+    '''
+    Waits until every task in tasks is done, including tasks that are added while waiting.
+    report is called with the number of finished tasks and the number of all tasks.
+    '''
+    finished = set()
+    while True:
+        with tasks_lock:
+            remaining = tasks - finished
+        if not remaining:
+            return
+        # the tracks of a disc image are added before its split task is done, so none slip through
+        for task in futures.as_completed(remaining):
+            finished.add(task)
+            if report is not None:
+                with tasks_lock:
+                    total = len(tasks)
+                report(len(finished), total)
+
+def collect_finished_tasks(tasks: set):
+    # report failures and forget finished tasks so that a long running watch does not pile them up
+    with tasks_lock:
+        finished = [ task for task in tasks if task.done() ]
+        tasks.difference_update(finished)
+    for task in finished:
+        if task.exception() is not None:
+            print("  Task failed: {}".format(task.exception()))
+
+def stop_watching(signum, frame):
+    raise KeyboardInterrupt
+
+def watch_input_dir(job):
+    '''
+    Converts files that are added or changed below the input directory until interrupted.
+    '''
+    libc, fd = inotify_init()
+    watches = {}
+    inotify_watch_tree(libc, fd, job.input_dir, watches)
+    watch_output = job.input_dir.resolve() != job.output_dir.resolve()
+    pending = {}
+    known_fat32_names = len(_fat32_owners)
+
+    print("Watching {} for changes. Press Ctrl+C to stop.".format(job.input_dir))
+    while True:
+        for wd, mask, name in inotify_read(fd, 1.0):
+            if mask & IN_Q_OVERFLOW:
+                # events got lost, so look at every file again
+                print("Too many changes at once. Rescanning {}".format(job.input_dir))
+                for found in inotify_watch_tree(libc, fd, job.input_dir, watches):
+                    pending[found] = time.monotonic()
+                continue
+            if wd not in watches:
+                continue
+            path = Path(watches[wd], name)
+            if watch_output and job.output_dir.resolve() in path.resolve().parents:
+                continue
+            if mask & IN_ISDIR:
+                # directories that are moved in come with files that never produced an event
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    for found in inotify_watch_tree(libc, fd, path, watches):
+                        pending[found] = time.monotonic()
+            else:
+                pending[path] = time.monotonic()
+
+        # only pick up files that stopped changing
+        now = time.monotonic()
+        for path, last_change in list(pending.items()):
+            if now - last_change < job.settle_time:
+                continue
+            del pending[path]
+            if not path.is_file():
+                continue
+            out_dirpath = output_dirpath(job, str(path.parent))
+            if out_dirpath is not None:
+                if args.v:
+                    print("Detected change of " + str(path))
+                # the change may be a new picture, so the cover art of the folder is looked for again
+                coverart_dirs.discard(out_dirpath)
+                evaluate_file(job, str(path.parent), path.name, out_dirpath)
+        submit_queued([ job ])
+        if len(_fat32_owners) != known_fat32_names:
+            # a watch that gets killed must not hand the name of an existing output to another file on restart
+            known_fat32_names = len(_fat32_owners)
+            save_fat32_names()
+
+        collect_finished_tasks(copy_tasks)
+        collect_finished_tasks(convert_tasks)
+
+if args.batch:
+    if args.watch:
+        print("--watch cannot be combined with --batch")
+        exit(-1)
+    jobs = load_batch_jobs(args.batch)
+elif args.input_dir is None or args.output_dir is None:
+    parser.print_usage()
+    print("Either pass an input_dir and an output_dir or a --batch file")
+    exit(-1)
+else:
+    jobs = [ args ]
+
+# Check for runtime dependencies
+for ffpath in sorted(set(job.ffpath for job in jobs)):
+    try:
+        subprocess.call([ Path(ffpath), "-version" ], stdout=subprocess.PIPE, shell=False)
 
-    # setup temporary directory for intermediary steps
+    except (subprocess.SubprocessError, FileNotFoundError):
+        print("This uses the `ffmpeg` command. You need to make sure that ffmpeg and its dependent codec libraries are installed.")
+        print("If you have tried to use `-ffpath` make sure it points to the executable.")
+        exit(-1)
+
+if len(jobs) == 1:
+    if not prepare_job(jobs[0]):
+        exit(-1)
+else:
+    jobs = [ job for job in jobs if prepare_job(job) ]
+
+if args.watch and not sys.platform.startswith('linux'):
+    print("--watch relies on inotify and is only available on Linux")
+    exit(-1)
+
+stats_lock = threading.Lock()
+if any(job.fat for job in jobs):
+    load_fat32_names()
+tasks_lock = threading.Lock()
+coverart_dirs = set()
+cue_sheets = {}
+if args.plan:
+    calibration = load_calibration()
+    slot_times = []
+    for job in jobs:
+        for dirpath, dirnames, filenames in os.walk(job.input_dir):
+            dirnames.sort()
+            out_dirpath = output_dirpath(job, dirpath)
+            if out_dirpath is None:
+                continue
+            for name in sorted(filenames):
+                evaluate_file(job, dirpath, name, out_dirpath)
+        slot_times.append(plan_job(job, calibration))
+        print()
+
+    if len(jobs) > 1 and None not in slot_times:
+        print("All jobs together: estimated {} with {} workers".format(
+              format_duration(sum(slot_times) / min(args.max_workers, os.cpu_count())), args.max_workers))
+    exit(0)
+
+fingerprints = load_fingerprints()
+fingerprints_saved_at = time.monotonic()
+# setup temporary directory for intermediary steps
 with tempfile.TemporaryDirectory() as tempdir:
     # use thread queue for copying to ensure that long copy operations do not starve the conversion task pool
     with futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='copy') as copyexecutor:
@@ -356,68 +1208,63 @@ with tempfile.TemporaryDirectory() as tempdir:
         with futures.ThreadPoolExecutor(max_workers=args.max_workers, thread_name_prefix='converter') as convertexecutor:
             convert_tasks = set()
 
-            # if you passed ignore_not_empty, we don't want to run into a loop and reconvert music we already converted
-            if args.input_dir.resolve() == args.output_dir.resolve():
-                pop_element_from_list(args.ifm, args.ofm)
+            for job in jobs:
+                print("Starting conversion of folder {} to folder {}".format(job.input_dir, job.output_dir))
+                print("Files with the endings {} will be converted to {}".format(str(job.ifm), job.ofm))
+                print("Codec options to be passed to ffmpeg: ", str.join(' ', job.ffargs))
+                print()
 
-            print("Starting conversion of folder {} to folder {}".format(args.input_dir, args.output_dir))
-            print("Files with the endings {} will be converted to {}".format(str(args.ifm), args.ofm))
-            print("Codec options to be passed to ffmpeg: ", str.join(' ', args.ffargs))
-            print()
+                for dirpath, dirnames, filenames in os.walk(job.input_dir):
+                    dirnames.sort()
+                    if args.v:
+                        print("Currently evaluating directory " + dirpath)
 
-            for dirpath, dirnames, filenames in os.walk(args.input_dir):
-                if args.v:
-                    print("Currently evaluating directory " + dirpath)
-
-                ignore_dir = str(args.ignore_dir)
-                if ignore_dir != '.' and ignore_dir in dirpath:
-                    # Skip directory that is meant to be ignored
-                    continue
-
-                out_dirpath = Path(args.output_dir, Path(dirpath).relative_to(args.input_dir))
-                if args.fat:
-                    out_dirpath = make_fat32_compatible(out_dirpath)
-
-                out_dirpath.mkdir(exist_ok=True)
-
-                currfolder_hascoverart = False
-                for name in sorted(filenames):
-                    in_filepath = Path(dirpath, name)
-                    # Evaluate file
-                    if name.lower().endswith(tuple(args.ifm)):
-                        out_filepath = Path(out_dirpath, Path(name).stem + '.' + args.ofm)
-                        convert_tasks.add(convertexecutor.submit(convert_file, in_filepath, out_filepath))
-                        if not args.nocover and not currfolder_hascoverart:
-                            coverpath = extract_coverart(in_filepath, tempdir)
-                            if isinstance(coverpath, Path):
-                                if args.v:
-                                    print("  copying cover art " + str(coverpath) + " of " + str(name))
-                                copy_tasks.add(copyexecutor.submit(copy_file, coverpath, Path(out_dirpath, "cover" + coverpath.suffix)))
-                                currfolder_hascoverart = True
-                    else:
-                        if args.cfm == '*':
-                            pass
-                        elif name.lower().endswith(tuple(args.cfm)):
-                            pass
-                        elif nocopy:
-                            # Copy file to destination
-                            if args.v:
-                                print("  copying file: " + str(name))
-                            copy_tasks.add(copyexecutor.submit(copy_file, in_filepath, Path(out_dirpath, name)))
+                    out_dirpath = output_dirpath(job, dirpath)
+                    if out_dirpath is None:
+                        continue
+
+                    for name in sorted(filenames):
+                        evaluate_file(job, dirpath, name, out_dirpath)
 
+                    # a single job can start converting right away, batch jobs take turns once all are evaluated
+                    if len(jobs) == 1:
+                        submit_queued(jobs)
                     if not args.v:
-                        print("{} files to copy, {} files to convert".format(len(copy_tasks), len(convert_tasks)), end='\r')
+                        queued = collections.Counter(entry[0] for queued_job in jobs for entry in queued_job.queue)
+                        print("{} files to copy, {} files to convert".format(len(copy_tasks) + queued["copy"],
+                                                                            len(convert_tasks) + queued["convert"]), end='\r')
 
+            submit_queued(jobs)
             print("\nFile evaluation finished")
 
-            # show progress
-            if not args.v:
-                copies_completed = futures.as_completed(copy_tasks)
-                converts_completed = futures.as_completed(convert_tasks)
-                current_convert = 0
-                for el in converts_completed:
-                    current_convert += 1
-                    print("{} out of {} files converted".format(current_convert, len(convert_tasks)), end='\r')
+            if args.watch:
+                # container runtimes stop the watch with SIGTERM, which has to drain the converters just like Ctrl+C
+                signal.signal(signal.SIGTERM, stop_watching)
+                try:
+                    watch_input_dir(jobs[0])
+                except KeyboardInterrupt:
+                    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                    print("\nStopped watching. Waiting for running tasks to finish")
+                    # files that have not been started yet are picked up again by the next run
+                    copyexecutor.shutdown(wait=False, cancel_futures=True)
+                    convertexecutor.shutdown(wait=False, cancel_futures=True)
+
+            # show progress and wait for the tracks of disc images, which are submitted once their split is done
+            elif not args.v:
+                wait_for_tasks(convert_tasks, lambda finished, total: print("{} out of {} files converted".format(finished, total), end='\r'))
+            else:
+                wait_for_tasks(convert_tasks)
+
+    print("\nCompleted")
 
-            print("\nCompleted")
+save_calibration(jobs)
+if any(job.fat for job in jobs):
+    save_fat32_names()
+save_fingerprints()
 
+if len(jobs) > 1:
+    print("\nReport per job:")
+    for job in jobs:
+        print("  {} -> {}: {} converted, {} copied, {} failed in {:.1f}s".format(
+              job.input_dir, job.output_dir, job.stats["convert"], job.stats["copy"], job.stats["failed"],
+              job.finished_at - job.started_at))
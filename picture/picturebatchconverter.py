@@ -14,8 +14,33 @@ import subprocess
 import random
 import string
 import re
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import json
+import copy
+import collections
+import functools
+import threading
+import signal
+import platform
+import hashlib
 from concurrent import futures
 
+def run_measured(cmd, output=None) -> subprocess.CompletedProcess:
+    # wait4 reports the CPU time of exactly this child, even while other threads run conversions
+    process = subprocess.Popen(cmd, shell=False, stdout=output, stderr=subprocess.STDOUT)
+    stdout = process.stdout.read() if process.stdout else None
+    pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.stdout:
+        process.stdout.close()
+    result = subprocess.CompletedProcess(cmd, process.returncode, stdout)
+    result.cpu_time = rusage.ru_utime + rusage.ru_stime
+    return result
+
 def exec_cmd(cmd, output=None):
     if isinstance(cmd, str):
         cmd = cmd.split(' ')
@@ -32,12 +57,63 @@ def exec_cmd(cmd, output=None):
         cmd.insert(1, "-n19")
         if args.v:
             print("  Executing command: {}".format(cmd))
-        return subprocess.run(cmd, shell=False, stdout=output, stderr=subprocess.STDOUT)
+        return run_measured(cmd, output)
     else:
         if args.v:
             print("  Executing command: {}".format(cmd))
         return subprocess.run(cmd, shell=False, stdout=output, stderr=subprocess.STDOUT)
 
+# Functions for watching the input directory with inotify
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+_inotify_event = struct.Struct('iIII')
+
+def inotify_init():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return libc, fd
+
+def inotify_watch_tree(libc, fd: int, root: Path, watches: dict) -> list:
+    '''
+    Watches root and all directories below it.
+    @returns list of files found in these directories
+    '''
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        wd = libc.inotify_add_watch(fd, os.fsencode(dirpath), IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd < 0:
+            print("Unable to watch directory {}: {}".format(dirpath, os.strerror(ctypes.get_errno())))
+            continue
+        watches[wd] = dirpath
+        found.extend(Path(dirpath, name) for name in sorted(filenames))
+    return found
+
+def inotify_read(fd: int, timeout: float) -> list:
+    '''
+    @returns list of (watch descriptor, mask, name) that occurred within timeout seconds
+    '''
+    ready, _, _ = select.select([ fd ], [], [], timeout)
+    if not ready:
+        return []
+    data = os.read(fd, 64 * 1024)
+    events = []
+    offset = 0
+    while offset < len(data):
+        wd, mask, cookie, length = _inotify_event.unpack_from(data, offset)
+        offset += _inotify_event.size
+        events.append((wd, mask, os.fsdecode(data[offset:offset + length].rstrip(b'\0'))))
+        offset += length
+    return events
+
 def random_string(length: int) -> str:
     chars = string.ascii_uppercase
     rnd_str = ""
@@ -45,37 +121,153 @@ def random_string(length: int) -> str:
         rnd_str += random.choice(chars)
     return rnd_str
 
-def make_fat32_compatible(file_path: Path) -> Path:
-    # Define a regular expression pattern for illegal characters
-    illegal_chars_pattern = re.compile(r'[<>:"/\\|?*\u0000-\u001F\u007F-\u009F]')
-
-    # Replace any illegal characters and unsupported Unicode characters with valid ones
-    fat32_compatible_path = []
-
-    # Evaluate each blob of the path
-    for element in file_path.parts:
-        if element == file_path.anchor:
+# Functions for mapping paths to names that FAT32 accepts
+_fat32_illegal_chars = re.compile(r'[<>:"/\\|?*\u0000-\u001F\u007F-\u009F]')
+_fat32_astral_chars = re.compile('[\U00010000-\U0010FFFF]')
+_fat32_suffix = re.compile(r'\.\w{1,8}$')
+_fat32_names = {}
+_fat32_owners = {}
+_fat32_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def fat32_table() -> dict:
+    # built on first use for every character of the BMP that has to be replaced or dropped
+    table = {}
+    for codepoint in range(0x10000):
+        char = chr(codepoint)
+        if _fat32_illegal_chars.match(char):
+            table[codepoint] = '_'
+        elif unicodedata.category(char) in ('Mn', 'Me', 'Cf', 'Cc'):
+            # Ignore combining, enclosing, formatting, and control characters
+            table[codepoint] = None
+    return table
+
+def fit_fat32_name(stem: str, suffix: str) -> str:
+    # long names on FAT32 hold at most 255 UTF-16 code units, the suffix is kept if the name is too long
+    while stem and len((stem + suffix).encode('utf-16-le', 'surrogatepass')) > 255 * 2:
+        stem = stem[:-1]
+    return (stem + suffix)[:255]
+
+def fat32_name(parent: tuple, element: str) -> str:
+    '''
+    Maps one component of a path. Components that would end up with the same name on FAT32,
+    which ignores case, get a hash of their original name appended.
+    '''
+    # Ignore characters beyond the BMP
+    name = _fat32_astral_chars.sub('', element.translate(fat32_table()))
+    # FAT32 drops trailing dots and spaces by itself
+    name = name.strip().rstrip('. ') or '_'
+    suffix_match = _fat32_suffix.search(name)
+    suffix = suffix_match.group() if suffix_match and suffix_match.start() > 0 else ''
+    name = fit_fat32_name(name[:len(name) - len(suffix)], suffix)
+
+    owner = _fat32_owners.setdefault((parent, name.casefold()), element)
+    if owner != element:
+        tag = "~" + hashlib.sha1(element.encode('utf-8', 'surrogateescape')).hexdigest()[:6]
+        name = fit_fat32_name(name[:len(name) - len(suffix)], tag + suffix)
+        _fat32_owners.setdefault((parent, name.casefold()), element)
+    _fat32_names[(parent, element)] = name
+    return name
+
+def make_fat32_compatible(root: Path, file_path: Path) -> Path:
+    '''
+    Maps the part of file_path below root to a path that FAT32 accepts. root is used as given.
+    Mapped components are remembered, so that deep trees are only sanitized once and every name
+    keeps its mapping for the whole run.
+    '''
+    fat32_compatible_path = list(root.parts)
+    for element in file_path.relative_to(root).parts:
+        if element in ('.', '..'):
             fat32_compatible_path.append(element)
-        else:
-            element_str = ""
-            for char in element:
-                if illegal_chars_pattern.match(char):
-                    element_str += '_'
-                elif unicodedata.category(char) in ['Mn', 'Me', 'Cf', 'Cc']:
-                    # Ignore combining, enclosing, formatting, and control characters
-                    pass
-                elif ord(char) > 0xFFFF:
-                    # Ignore characters beyond the BMP
-                    pass
-                else:
-                    element_str += char
-
-            # Ensure that the resulting path doesn't exceed the maximum length limit of FAT32
-            element_str = element_str.strip()[:255]
-            fat32_compatible_path.append(element_str)
+            continue
+        parent = tuple(fat32_compatible_path)
+        name = _fat32_names.get((parent, element))
+        if name is None:
+            with _fat32_lock:
+                name = _fat32_names.get((parent, element)) or fat32_name(parent, element)
+        fat32_compatible_path.append(name)
 
     return Path(*fat32_compatible_path)
 
+fat32_names_file = Path(os.environ.get("XDG_CACHE_HOME", Path.home().joinpath(".cache")), "pymediascripts", "fat32", "picturebatchconverter.json")
+
+def load_fat32_names():
+    '''
+    Restores which source name owns which FAT32 name, so that a name that got a suffix on an earlier run
+    keeps it even if a new colliding name is found first.
+    '''
+    try:
+        with open(fat32_names_file, "r") as fatfhandle:
+            owners = json.load(fatfhandle)
+    except (OSError, ValueError):
+        return
+    for parent, names in owners.items():
+        for name, element in names.items():
+            _fat32_owners[(Path(parent).parts, name)] = element
+
+def save_fat32_names():
+    owners = {}
+    with _fat32_lock:
+        for (parent, name), element in _fat32_owners.items():
+            owners.setdefault(str(Path(*parent)), {})[name] = element
+    try:
+        fat32_names_file.parent.mkdir(parents=True, exist_ok=True)
+        partial_file = fat32_names_file.with_suffix(".{}.json".format(os.getpid()))
+        with open(partial_file, "w") as fatfhandle:
+            json.dump(owners, fatfhandle)
+        os.replace(partial_file, fat32_names_file)
+    except OSError as e:
+        print("Unable to store FAT32 names: {}".format(e))
+
+# Functions for reading image dimensions from file headers
+def read_jpeg_size(fhandle):
+    # walk the JPEG markers up to the first start of frame
+    if fhandle.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        byte = fhandle.read(1)
+        while byte and byte != b'\xff':
+            byte = fhandle.read(1)
+        while byte == b'\xff':
+            byte = fhandle.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+            # markers without payload
+            continue
+        length = int.from_bytes(fhandle.read(2), 'big')
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            frame = fhandle.read(5)
+            if len(frame) < 5:
+                return None
+            return int.from_bytes(frame[3:5], 'big'), int.from_bytes(frame[1:3], 'big')
+        fhandle.seek(length - 2, os.SEEK_CUR)
+
+def read_image_megapixels(in_filepath: Path) -> float:
+    '''
+    Reads the dimensions of JPEG, PNG, GIF and BMP files without decoding them.
+    @returns megapixels or None if unknown
+    '''
+    try:
+        with open(in_filepath, "rb") as imgfhandle:
+            head = imgfhandle.read(26)
+            if head.startswith(b'\xff\xd8'):
+                imgfhandle.seek(0)
+                size = read_jpeg_size(imgfhandle)
+            elif head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+                size = struct.unpack(">II", head[16:24])
+            elif head.startswith((b'GIF87a', b'GIF89a')):
+                size = struct.unpack("<HH", head[6:10])
+            elif head.startswith(b'BM'):
+                size = struct.unpack("<ii", head[18:26])
+            else:
+                size = None
+    except (OSError, struct.error):
+        return None
+    # BMPs that are stored top-down have a negative height
+    return size and abs(size[0] * size[1]) / 1000000
+
 # Argument custom validators
 def remove_empty_from_list(li):
     try:
@@ -132,8 +324,11 @@ def argcheck_ms(string) -> int:
                  "gb": 1000**3, "g": 1000**3, "gib": 1024**3,
                  "tb": 1000**4, "t": 1000**4, "tib": 1024**4,
                  "pb": 1000**4, "p": 1000**4, "pib": 1024**5}
-        number, unit = [element.strip() for element in ms_string.split()]
-        ms_val = int(float(number)*units[unit])
+        # the unit may follow the number with or without a space
+        match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([a-z]+)", ms_string)
+        if not match or match.group(2) not in units:
+            raise argparse.ArgumentTypeError('Expected a size like: 100KiB or 1MiB')
+        ms_val = int(float(match.group(1))*units[match.group(2)])
 
     return max(0, ms_val)
 def argcheck_cjxlpath(string) -> str:
@@ -183,12 +378,23 @@ try:
 
     Using a custom cjxl version from a container
     ./picturebatchconverter.py -v -cjxlpath "podman run --rm -v $PWD:/temp/ rando/cjxl" /temp/music-album /temp/out
+
+    Many folders in one go, sharing one pool of converters:
+    ./picturebatchconverter.py --batch jobs.toml
+
+    where jobs.toml lists the jobs with the long names of their options:
+    [[job]]
+    input_dir = "holiday"
+    output_dir = "/backup/holiday"
+    preset = "visual_lossless"
+    minimumfilesize = "100KiB"
     ''')
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=descrp)
 
-    parser.add_argument("input_dir", type=Path, help="path to input folder. Use \\ or \" for names with spaces")
-    parser.add_argument("output_dir", type=Path, help="output folder. Use \\ or \" for names with spaces")
+    parser.add_argument("input_dir", type=Path, nargs='?', help="path to input folder. Use \\ or \" for names with spaces")
+    parser.add_argument("output_dir", type=Path, nargs='?', help="output folder. Use \\ or \" for names with spaces")
+    parser.add_argument("--batch", type=Path, help="TOML or JSON file with a list of jobs, each with its own input_dir, output_dir and options. Options given on the command line apply to all jobs. All jobs share one pool of converters.")
     parser.add_argument("--ignore-dir", type=Path, help="Ignore directory with the specified folder name.")
     parser.add_argument("--ignore-not-empty", action="store_true", help="continue even if the output directory contains files. This overwrites existing files.")
     parser.add_argument("--ignore-not-empty-and-preserve",action="store_true", help="continue even if the output directory contains files. Skip existing files with the same name.")
@@ -206,6 +412,9 @@ try:
     parser.add_argument("-p", "--preset", default="", type=argcheck_preset,
                         help="Set a preset that overwrites other arguments. Possible values: visual_lossless, true_lossless, balanced")
     parser.add_argument("-fat", "--fat32-compatible", dest="fat", help="Ensure that paths and filenames are compliant with FAT32 filesystems", action="store_true")
+    parser.add_argument("--watch", help="Keep running after the initial conversion and convert new or changed files as soon as they stopped changing. Files whose output is newer than their source are skipped. Linux only.", action="store_true")
+    parser.add_argument("--settle-time", dest="settle_time", default=10.0, type=float, help="Seconds a file must not have changed before it is converted in --watch mode.")
+    parser.add_argument("--plan", help="Do not convert anything. Count the files that would be converted, copied or skipped, read their pixel count and estimate run time and output size from earlier runs with the same options on this host.", action="store_true")
 
     args = parser.parse_args()
 
@@ -213,79 +422,457 @@ except Exception as e:
     print(e)
     exit(-1)
 
-# Check for runtime dependencies
-try:
-    subprocess.call([ Path(args.cjxlpath), "-h" ], stdout=subprocess.PIPE, shell=False)
-
-except (subprocess.SubprocessError, FileNotFoundError):
-    print("This uses the `cjxl` command. You need to make sure that cjxl and its dependent codec libraries are installed.")
-    print("If you have tried to use `-cjxlpath` make sure it points to the executable.")
-    exit(-1)
-
-if not args.ignore_not_empty and not args.ignore_not_empty_and_preserve and args.output_dir.exists() and len(os.listdir(args.output_dir)) > 0:
-    print("Your output directory is not empty. If you continue using --ignore-not-empty-and-preserve existing files with the same name are preserved.")
-    exit(-1)
+def job_to_argv(job: dict) -> list:
+    # options of a job in the batch file are named like the long command line options
+    argv = []
+    for key, value in job.items():
+        if key in ("input_dir", "output_dir"):
+            continue
+        option = "--" + key.replace('_', '-')
+        if value is True:
+            argv.append(option)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, list):
+            argv.append("{}={}".format(option, ",".join(str(el) for el in value)))
+        else:
+            argv.append("{}={}".format(option, value))
+    argv.extend([ str(job["input_dir"]), str(job["output_dir"]) ])
+    return argv
+
+def load_batch_jobs(batch_path: Path) -> list:
+    '''
+    Reads the jobs of a batch file.
+    @returns list of argument namespaces, one per job
+    '''
+    if batch_path.suffix.lower() == ".toml":
+        import tomllib
+        with open(batch_path, "rb") as batchfhandle:
+            batch = tomllib.load(batchfhandle)
+    else:
+        with open(batch_path, "r") as batchfhandle:
+            batch = json.load(batchfhandle)
+    if isinstance(batch, dict):
+        batch = batch.get("job", batch.get("jobs", []))
+
+    jobs = []
+    for job in batch:
+        if "input_dir" not in job or "output_dir" not in job:
+            print("Every job needs an input_dir and an output_dir: {}".format(job))
+            exit(-1)
+        # the command line arguments serve as defaults of every job
+        jobs.append(parser.parse_args(job_to_argv(job), namespace=copy.deepcopy(args)))
+    return jobs
+
+def prepare_job(job) -> bool:
+    '''
+    Applies the preset of a job.
+    @returns False if the job cannot run
+    '''
+    if not job.ignore_not_empty and not job.ignore_not_empty_and_preserve and not job.watch and not job.plan and job.output_dir.exists() and len(os.listdir(job.output_dir)) > 0:
+        print("Your output directory {} is not empty. If you continue using --ignore-not-empty-and-preserve existing files with the same name are preserved.".format(job.output_dir))
+        return False
+
+    if not job.cjxlargs and not job.preset:
+        print("You neither selected a preset nor set any cjxl arguments. Selecting the balanced preset for you...")
+        job.preset = 3
+
+    apply_preset(job)
+
+    if job.fat:
+        # the owners of FAT32 names are remembered by their parent, which has to be the same from any working directory
+        job.output_dir = job.output_dir.absolute()
+
+    # if you passed ignore_not_empty, we don't want to run into a loop and reconvert pics we already converted
+    if job.input_dir.resolve() == job.output_dir.resolve():
+        pop_element_from_list(job.ifm, job.ofm)
+
+    # files of a job are queued here and handed to the shared converters in turns
+    job.queue = collections.deque()
+    job.stats = collections.Counter()
+    job.started_at = time.monotonic()
+    job.finished_at = job.started_at
+    return True
+
+def apply_preset(job):
+    if job.preset == 1:
+        # visual_lossless
+        job.ofm = argcheck_ofm("jxl")
+        job.cjxlargs = argcheck_cjxlargs("-d 0.9 --lossless_jpeg=0")
+
+    if job.preset == 2:
+        # true_lossless
+        job.ofm = argcheck_ofm("jxl")
+        job.cjxlargs = argcheck_cjxlargs("-d 0 --lossless_jpeg=1")
+        if job.cjxleffort == 0:
+            job.cjxleffort = 9
+
+    if job.preset == 3:
+        # balanced
+        job.ofm = argcheck_ofm("jxl")
+        job.cjxlargs = argcheck_cjxlargs("-q 80 --lossless_jpeg=0")
+
+def is_up_to_date(in_filepath: Path, out_filepath: Path) -> bool:
+    # in watch mode files are only converted again when their source changed
+    try:
+        return out_filepath.stat().st_mtime >= in_filepath.stat().st_mtime
+    except OSError:
+        return False
 
-if not args.cjxlargs and not args.preset:
-    print("You neither selected a preset nor set any cjxl arguments. Selecting the balanced preset for you...")
-    args.preset = 3
-
-# apply preset
-if args.preset == 1:
-    # visual_lossless
-    args.ofm = argcheck_ofm("jxl")
-    args.cjxlargs = argcheck_cjxlargs("-d 0.9 --lossless_jpeg=0")
-
-if args.preset == 2:
-    # true_lossless
-    args.ofm = argcheck_ofm("jxl")
-    args.cjxlargs = argcheck_cjxlargs("-d 0 --lossless_jpeg=1")
-    if args.cjxleffort == 0:
-        args.cjxleffort = 9
-
-if args.preset == 3:
-    # balanced
-    args.ofm = argcheck_ofm("jxl")
-    args.cjxlargs = argcheck_cjxlargs("-q 80 --lossless_jpeg=0")
-
-def copy_file(in_filepath: Path, out_filepath: Path) -> Path:
-    if args.fat:
-        out_filepath = make_fat32_compatible(out_filepath)
-    if args.ignore_not_empty_and_preserve and out_filepath.exists():
+def copy_file(job, in_filepath: Path, out_filepath: Path) -> Path:
+    if job.ignore_not_empty_and_preserve and out_filepath.exists():
         if args.v:
             print("  File {} already exists. Skipping".format(out_filepath))
         return
+    if job.watch and is_up_to_date(in_filepath, out_filepath):
+        return
 
     shutil.copyfile(in_filepath, out_filepath, follow_symlinks=False)
 
-def convert_file(in_filepath: Path, out_filepath: Path, recursive: bool) -> Path:
-    if args.fat:
-        out_filepath = make_fat32_compatible(out_filepath)
-
-    if args.ignore_not_empty_and_preserve and out_filepath.exists():
+def convert_file(job, in_filepath: Path, out_filepath: Path, recursive: bool = False) -> Path:
+    if job.ignore_not_empty_and_preserve and out_filepath.exists():
         if args.v:
             print("  File {} already exists. Skipping".format(out_filepath))
         return
+    if not recursive and job.watch and is_up_to_date(in_filepath, out_filepath):
+        if args.v:
+            print("  File {} is up to date. Skipping".format(out_filepath))
+        return
 
-    cmd = [ Path(args.cjxlpath), Path(in_filepath), Path(out_filepath) ]
-    if args.vv:
+    started_at = time.monotonic()
+    cmd = [ Path(job.cjxlpath), Path(in_filepath), Path(out_filepath) ]
+    if job.vv:
         cmd.extend([ '--verbose' ])
-    if args.cjxleffort > 0 and args.cjxleffort < 10:
-        cmd.extend([ '-e', str(args.cjxleffort) ])
-    cmd.extend(args.cjxlargs)
-    exec_cmd(cmd)
+    if job.cjxleffort > 0 and job.cjxleffort < 10:
+        cmd.extend([ '-e', str(job.cjxleffort) ])
+    cmd.extend(job.cjxlargs)
+    result = exec_cmd(cmd)
+    if not recursive:
+        # files that need magick's help are left out of the calibration
+        record_conversion(job, in_filepath, out_filepath, read_image_megapixels(in_filepath),
+                          getattr(result, "cpu_time", 0.0), started_at)
 
     if not recursive and not out_filepath.exists():
         if args.v:
             print("  Conversion of {} failed. Using magick to help out".format(out_filepath))
         intermediary_path = Path(out_filepath.parent, out_filepath.stem + ".png")
-        cmd = [ Path(args.magickpath), Path(in_filepath), "-render", "-auto-orient", Path(intermediary_path) ]
+        cmd = [ Path(job.magickpath), Path(in_filepath), "-render", "-auto-orient", Path(intermediary_path) ]
         exec_cmd(cmd)
-        convert_file(intermediary_path, out_filepath, True)
+        convert_file(job, intermediary_path, out_filepath, True)
         os.remove(intermediary_path)
         if not out_filepath.exists():
             print("  Unable to read and convert {}. Copying instead as is.")
-            copy_file(in_filepath, out_filepath)
+            copy_file(job, in_filepath, out_filepath)
+
+def output_dirpath(job, dirpath: str) -> Path:
+    '''
+    Creates the output directory matching dirpath.
+    @returns the output directory before it is made FAT32 compatible or None if dirpath is ignored
+    '''
+    ignore_dir = str(job.ignore_dir)
+    if ignore_dir != '.' and ignore_dir in dirpath:
+        # Skip directory that is meant to be ignored
+        return None
+
+    out_dirpath = Path(job.output_dir, Path(dirpath).relative_to(job.input_dir))
+    if not job.plan:
+        (make_fat32_compatible(job.output_dir, out_dirpath) if job.fat else out_dirpath).mkdir(parents=True, exist_ok=True)
+    return out_dirpath
+
+def queue_task(job, kind: str, fun, in_filepath: Path, out_filepath: Path):
+    # output paths are mapped here in the order of evaluation, so that colliding names are told apart the same way every run
+    if job.fat:
+        out_filepath = make_fat32_compatible(job.output_dir, out_filepath)
+    job.queue.append((kind, fun, in_filepath, out_filepath))
+
+def evaluate_file(job, dirpath: str, name: str, out_dirpath: Path):
+    in_filepath = Path(dirpath, name)
+    # Evaluate file
+    if name.lower().endswith(tuple(job.ifm)):
+        out_filepath = Path(out_dirpath, Path(name).stem + '.' + job.ofm)
+        if job.minimumfilesize > 0 and job.minimumfilesize > in_filepath.stat().st_size:
+            queue_task(job, "copy", copy_file, in_filepath, out_filepath)
+        else:
+            queue_task(job, "convert", convert_file, in_filepath, out_filepath)
+    else:
+        if job.cfm == '*' or name.lower().endswith(tuple(job.cfm)):
+            with stats_lock:
+                job.stats["skipped"] += 1
+        else:
+            # Copy file to destination
+            if args.v:
+                print("  copying file: " + str(name))
+            queue_task(job, "copy", copy_file, in_filepath, Path(out_dirpath, name))
+
+def calibration_host() -> str:
+    '''
+    Names the hardware that estimates are measured on. Containers get a new hostname on every run,
+    so the CPU model and the number of cores are used unless PYMEDIASCRIPTS_CALIBRATION_HOST is set.
+    '''
+    host = os.environ.get("PYMEDIASCRIPTS_CALIBRATION_HOST")
+    if host:
+        return host
+    cpu_model = platform.processor() or platform.machine()
+    try:
+        with open("/proc/cpuinfo", "r") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("model name"):
+                    cpu_model = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return "{} x{}".format(cpu_model, os.cpu_count())
+
+def calibration_key(job) -> str:
+    # estimates only carry over to runs on the same hardware with the same conversion options
+    return "{} {} -e {} {}".format(calibration_host(), job.ofm, job.cjxleffort, " ".join(job.cjxlargs))
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} TiB".format(size)
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}h {:02d}m {:02d}s".format(hours, minutes, seconds)
+
+calibration_file = Path(os.environ.get("XDG_CACHE_HOME", Path.home().joinpath(".cache")), "pymediascripts", "calibration", "picturebatchconverter.json")
+calibration_fields = ("units", "cpu_time", "slot_time", "in_bytes", "out_bytes")
+
+def load_calibration() -> dict:
+    try:
+        with open(calibration_file, "r") as calfhandle:
+            return json.load(calfhandle)
+    except (OSError, ValueError):
+        return {}
+
+def save_calibration(jobs: list):
+    calibration = load_calibration()
+    for job in jobs:
+        if job.stats["units"] <= 0:
+            continue
+        entry = calibration.setdefault(calibration_key(job), {})
+        for field in calibration_fields:
+            # older runs fade out so that the estimates follow new hardware and encoder versions
+            entry[field] = entry.get(field, 0.0) * 0.75 + job.stats[field]
+    try:
+        calibration_file.parent.mkdir(parents=True, exist_ok=True)
+        partial_file = calibration_file.with_suffix(".{}.json".format(os.getpid()))
+        with open(partial_file, "w") as calfhandle:
+            json.dump(calibration, calfhandle, indent=1)
+        os.replace(partial_file, calibration_file)
+    except OSError as e:
+        print("Unable to store calibration data: {}".format(e))
+
+def record_conversion(job, in_filepath: Path, out_filepath: Path, units: float, cpu_time: float, started_at: float):
+    # measurements of every converted file calibrate the estimates of --plan
+    if units is None or not out_filepath.exists():
+        return
+    with stats_lock:
+        job.stats["units"] += units
+        job.stats["cpu_time"] += cpu_time
+        job.stats["slot_time"] += time.monotonic() - started_at
+        job.stats["in_bytes"] += in_filepath.stat().st_size
+        job.stats["out_bytes"] += out_filepath.stat().st_size
+
+def plan_job(job, calibration: dict) -> float:
+    '''
+    Probes the queued files of a job instead of converting them and prints the estimates.
+    @returns estimated converter time in seconds or None without calibration data
+    '''
+    plan = collections.Counter()
+    formats = collections.Counter()
+    for kind, fun, in_filepath, out_filepath in job.queue:
+        if (job.ignore_not_empty_and_preserve and out_filepath.exists()) or (job.watch and is_up_to_date(in_filepath, out_filepath)):
+            job.stats["skipped"] += 1
+            continue
+        size = in_filepath.stat().st_size
+        if kind == "copy":
+            plan["copy"] += 1
+            plan["copy_bytes"] += size
+            continue
+        plan["convert"] += 1
+        plan["in_bytes"] += size
+        formats[in_filepath.suffix.lower().lstrip('.')] += 1
+        units = read_image_megapixels(in_filepath)
+        if units is None:
+            plan["unprobed_bytes"] += size
+        else:
+            plan["units"] += units
+            plan["probed_bytes"] += size
+    job.queue.clear()
+
+    entry = calibration.get(calibration_key(job))
+    # files that could not be probed are assumed to be like the others of similar size
+    if plan["unprobed_bytes"] and plan["probed_bytes"]:
+        plan["units"] += plan["unprobed_bytes"] * plan["units"] / plan["probed_bytes"]
+    elif plan["unprobed_bytes"] and entry:
+        plan["units"] += plan["unprobed_bytes"] * entry["units"] / entry["in_bytes"]
+
+    print("Plan for folder {} to folder {}".format(job.input_dir, job.output_dir))
+    print("  {} files to convert ({}, {:.1f} megapixels), {} files to copy ({}), {} files skipped".format(
+          plan["convert"], format_size(plan["in_bytes"]), plan["units"],
+          plan["copy"], format_size(plan["copy_bytes"]), job.stats["skipped"]))
+    if formats:
+        print("  Formats to convert: " + ", ".join("{} {}".format(ending, count) for ending, count in formats.most_common()))
+    if not entry:
+        print("  No calibration data for these options on {} yet. Convert once to calibrate the estimates.".format(calibration_host()))
+        return None
+
+    slot_time = plan["units"] * entry["slot_time"] / entry["units"]
+    out_bytes = plan["in_bytes"] * entry["out_bytes"] / entry["in_bytes"] + plan["copy_bytes"]
+    print("  Estimated {} with {} workers, {} of CPU time, {} of output".format(
+          format_duration(slot_time / min(args.max_workers, os.cpu_count())), args.max_workers,
+          format_duration(plan["units"] * entry["cpu_time"] / entry["units"]), format_size(out_bytes)))
+    return slot_time
+
+def finish_task(job, kind: str, task: futures.Future):
+    with stats_lock:
+        if task.exception() is not None:
+            job.stats["failed"] += 1
+        else:
+            job.stats[kind] += 1
+        job.finished_at = time.monotonic()
+
+def submit_queued(jobs: list):
+    '''
+    Hands the queued files of all jobs to the shared executors, taking turns between jobs
+    so that every job makes progress instead of one job after the other.
+    '''
+    while any(job.queue for job in jobs):
+        for job in jobs:
+            if not job.queue:
+                continue
+            kind, fun, in_filepath, out_filepath = job.queue.popleft()
+            if kind == "convert":
+                task = convertexecutor.submit(fun, job, in_filepath, out_filepath)
+                convert_tasks.add(task)
+            else:
+                task = copyexecutor.submit(fun, job, in_filepath, out_filepath)
+                copy_tasks.add(task)
+            task.add_done_callback(functools.partial(finish_task, job, kind))
+
+def collect_finished_tasks(tasks: set):
+    # report failures and forget finished tasks so that a long running watch does not pile them up
+    for task in [ task for task in tasks if task.done() ]:
+        tasks.discard(task)
+        if task.exception() is not None:
+            print("  Task failed: {}".format(task.exception()))
+
+def stop_watching(signum, frame):
+    raise KeyboardInterrupt
+
+def watch_input_dir(job):
+    '''
+    Converts files that are added or changed below the input directory until interrupted.
+    '''
+    libc, fd = inotify_init()
+    watches = {}
+    inotify_watch_tree(libc, fd, job.input_dir, watches)
+    watch_output = job.input_dir.resolve() != job.output_dir.resolve()
+    pending = {}
+    known_fat32_names = len(_fat32_owners)
+
+    print("Watching {} for changes. Press Ctrl+C to stop.".format(job.input_dir))
+    while True:
+        for wd, mask, name in inotify_read(fd, 1.0):
+            if mask & IN_Q_OVERFLOW:
+                # events got lost, so look at every file again
+                print("Too many changes at once. Rescanning {}".format(job.input_dir))
+                for found in inotify_watch_tree(libc, fd, job.input_dir, watches):
+                    pending[found] = time.monotonic()
+                continue
+            if wd not in watches:
+                continue
+            path = Path(watches[wd], name)
+            if watch_output and job.output_dir.resolve() in path.resolve().parents:
+                continue
+            if mask & IN_ISDIR:
+                # directories that are moved in come with files that never produced an event
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    for found in inotify_watch_tree(libc, fd, path, watches):
+                        pending[found] = time.monotonic()
+            else:
+                pending[path] = time.monotonic()
+
+        # only pick up files that stopped changing
+        now = time.monotonic()
+        for path, last_change in list(pending.items()):
+            if now - last_change < job.settle_time:
+                continue
+            del pending[path]
+            if not path.is_file():
+                continue
+            out_dirpath = output_dirpath(job, str(path.parent))
+            if out_dirpath is not None:
+                if args.v:
+                    print("Detected change of " + str(path))
+                evaluate_file(job, str(path.parent), path.name, out_dirpath)
+        submit_queued([ job ])
+        if len(_fat32_owners) != known_fat32_names:
+            # a watch that gets killed must not hand the name of an existing output to another file on restart
+            known_fat32_names = len(_fat32_owners)
+            save_fat32_names()
+
+        collect_finished_tasks(copy_tasks)
+        collect_finished_tasks(convert_tasks)
+
+if args.batch:
+    if args.watch:
+        print("--watch cannot be combined with --batch")
+        exit(-1)
+    jobs = load_batch_jobs(args.batch)
+elif args.input_dir is None or args.output_dir is None:
+    parser.print_usage()
+    print("Either pass an input_dir and an output_dir or a --batch file")
+    exit(-1)
+else:
+    jobs = [ args ]
+
+# Check for runtime dependencies
+for cjxlpath in sorted(set(job.cjxlpath for job in jobs)):
+    try:
+        subprocess.call([ Path(cjxlpath), "-h" ], stdout=subprocess.PIPE, shell=False)
+
+    except (subprocess.SubprocessError, FileNotFoundError):
+        print("This uses the `cjxl` command. You need to make sure that cjxl and its dependent codec libraries are installed.")
+        print("If you have tried to use `-cjxlpath` make sure it points to the executable.")
+        exit(-1)
+
+if len(jobs) == 1:
+    if not prepare_job(jobs[0]):
+        exit(-1)
+else:
+    jobs = [ job for job in jobs if prepare_job(job) ]
+
+if args.watch and not sys.platform.startswith('linux'):
+    print("--watch relies on inotify and is only available on Linux")
+    exit(-1)
+
+stats_lock = threading.Lock()
+if any(job.fat for job in jobs):
+    load_fat32_names()
+if args.plan:
+    calibration = load_calibration()
+    slot_times = []
+    for job in jobs:
+        for dirpath, dirnames, filenames in os.walk(job.input_dir):
+            dirnames.sort()
+            out_dirpath = output_dirpath(job, dirpath)
+            if out_dirpath is None:
+                continue
+            for name in sorted(filenames):
+                evaluate_file(job, dirpath, name, out_dirpath)
+        slot_times.append(plan_job(job, calibration))
+        print()
+
+    if len(jobs) > 1 and None not in slot_times:
+        print("All jobs together: estimated {} with {} workers".format(
+              format_duration(sum(slot_times) / min(args.max_workers, os.cpu_count())), args.max_workers))
+    exit(0)
 
 # use thread queue for copying to ensure that long copy operations do not starve the conversion task pool
 with futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='copy') as copyexecutor:
@@ -294,57 +881,49 @@ with futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='copy') as cop
     with futures.ThreadPoolExecutor(max_workers=args.max_workers, thread_name_prefix='converter') as convertexecutor:
         convert_tasks = set()
 
-        # if you passed ignore_not_empty, we don't want to run into a loop and reconvert pics we already converted
-        if args.input_dir.resolve() == args.output_dir.resolve():
-            pop_element_from_list(args.ifm, args.ofm)
-        
-        print("Starting conversion of folder {} to folder {}".format(args.input_dir, args.output_dir))
-        print("Files with the endings {} will be converted to {}".format(str(args.ifm), args.ofm))
-        print("Codec options to be passed to cjxl: ", str.join(' ', args.cjxlargs))
-        print()
+        for job in jobs:
+            print("Starting conversion of folder {} to folder {}".format(job.input_dir, job.output_dir))
+            print("Files with the endings {} will be converted to {}".format(str(job.ifm), job.ofm))
+            print("Codec options to be passed to cjxl: ", str.join(' ', job.cjxlargs))
+            print()
 
-        for dirpath, dirnames, filenames in os.walk(args.input_dir):
-            if args.v:
-                print("Currently evaluating directory " + dirpath)
-
-            ignore_dir = str(args.ignore_dir)
-            if ignore_dir != '.' and ignore_dir in dirpath:
-                # Skip directory that is meant to be ignored
-                continue
-
-            out_dirpath = Path(args.output_dir, Path(dirpath).relative_to(args.input_dir))
-            if args.fat:
-                out_dirpath = make_fat32_compatible(out_dirpath)
+            for dirpath, dirnames, filenames in os.walk(job.input_dir):
+                dirnames.sort()
+                if args.v:
+                    print("Currently evaluating directory " + dirpath)
 
-            out_dirpath.mkdir(exist_ok=True)
+                out_dirpath = output_dirpath(job, dirpath)
+                if out_dirpath is None:
+                    continue
 
-            for name in sorted(filenames):
-                in_filepath = Path(dirpath, name)
-                # Evaluate file
-                if name.lower().endswith(tuple(args.ifm)):
-                    out_filepath = Path(out_dirpath, Path(name).stem + '.' + args.ofm)
-                    if args.minimumfilesize > 0 and args.minimumfilesize > in_filepath.stat().st_size:
-                        copy_tasks.add(copyexecutor.submit(copy_file, in_filepath, out_filepath))
-                    else:
-                        convert_tasks.add(convertexecutor.submit(convert_file, in_filepath, out_filepath, False))
-                else:
-                    if args.cfm == '*':
-                        pass
-                    elif name.lower().endswith(tuple(args.cfm)):
-                        pass
-                    else:
-                        # Copy file to destination
-                        if args.v:
-                            print("  copying file: " + str(name))
-                        copy_tasks.add(copyexecutor.submit(copy_file, in_filepath, Path(out_dirpath, name)))
+                for name in sorted(filenames):
+                    evaluate_file(job, dirpath, name, out_dirpath)
 
+                # a single job can start converting right away, batch jobs take turns once all are evaluated
+                if len(jobs) == 1:
+                    submit_queued(jobs)
                 if not args.v:
-                    print("{} files to copy, {} files to convert".format(len(copy_tasks), len(convert_tasks)), end='\r')
+                    queued = collections.Counter(entry[0] for queued_job in jobs for entry in queued_job.queue)
+                    print("{} files to copy, {} files to convert".format(len(copy_tasks) + queued["copy"],
+                                                                        len(convert_tasks) + queued["convert"]), end='\r')
 
+        submit_queued(jobs)
         print("\nFile evaluation finished")
 
+        if args.watch:
+            # container runtimes stop the watch with SIGTERM, which has to drain the converters just like Ctrl+C
+            signal.signal(signal.SIGTERM, stop_watching)
+            try:
+                watch_input_dir(jobs[0])
+            except KeyboardInterrupt:
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                print("\nStopped watching. Waiting for running tasks to finish")
+                # files that have not been started yet are picked up again by the next run
+                copyexecutor.shutdown(wait=False, cancel_futures=True)
+                convertexecutor.shutdown(wait=False, cancel_futures=True)
+
         # show progress
-        if not args.v:
+        elif not args.v:
             copies_completed = futures.as_completed(copy_tasks)
             converts_completed = futures.as_completed(convert_tasks)
             current_convert = 0
@@ -353,3 +932,14 @@ with futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='copy') as cop
                 print("{} out of {} files converted".format(current_convert, len(convert_tasks)), end='\r')
 
         print("\nCompleted")
+
+save_calibration(jobs)
+if any(job.fat for job in jobs):
+    save_fat32_names()
+
+if len(jobs) > 1:
+    print("\nReport per job:")
+    for job in jobs:
+        print("  {} -> {}: {} converted, {} copied, {} failed in {:.1f}s".format(
+              job.input_dir, job.output_dir, job.stats["convert"], job.stats["copy"], job.stats["failed"],
+              job.finished_at - job.started_at))